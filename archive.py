@@ -0,0 +1,177 @@
+""" LeeTV monthly archive module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  archive.py
+#
+#  Indexed .tar.gz archives for logs and playlists
+#
+#  Every member is compressed as its own gzip member, so the
+#  archive is still a perfectly normal .tar.gz ('tar zxvf'
+#  works as always), but a single file can be pulled out by
+#  seeking straight to it instead of decompressing the whole
+#  month.  The offsets live in a small text index next to the
+#  archive (name.tar.gz.idx), one line per member:
+#
+#      member <tab> offset <tab> length
+#
+import os
+import io
+import zlib
+import tarfile
+
+# read/compress in chunks this size
+CHUNK = 1024 * 1024
+
+
+def index_name(archive):
+    """ filename of the index belonging to an archive """
+    return archive + '.idx'
+
+
+def read_index(archive):
+    """ return {member: (offset, length)} or None if there is no index """
+    index = {}
+    try:
+        with open(index_name(archive), 'r') as fp:
+            for line in fp:
+                name, offset, length = line.rstrip('\n').split('\t')
+                index[name] = (int(offset), int(length))
+    except (OSError, ValueError):
+        return None
+    return index
+
+
+def write_index(archive, index):
+    """ save the member index of an archive """
+    with open(index_name(archive), 'w') as fp:
+        for name, (offset, length) in index.items():
+            fp.write('{}\t{}\t{}\n'.format(name, offset, length))
+
+
+def _compress_member(out, tarinfo, fileobj):
+    """ write one tar member as a separate gzip member, return its length """
+    start = out.tell()
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    out.write(z.compress(tarinfo.tobuf(tarfile.GNU_FORMAT)))
+    remaining = tarinfo.size
+    while remaining > 0:
+        data = fileobj.read(min(CHUNK, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        out.write(z.compress(data))
+    # pad to the next tar block
+    padding = (tarfile.BLOCKSIZE - tarinfo.size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+    out.write(z.compress(tarfile.NUL * padding))
+    out.write(z.flush())
+    return out.tell() - start
+
+
+def _copy_range(src, out, offset, length):
+    """ copy an already compressed member without touching it """
+    src.seek(offset)
+    while length > 0:
+        data = src.read(min(CHUNK, length))
+        if not data:
+            break
+        out.write(data)
+        length -= len(data)
+
+
+def write_archive(archive, files):
+    """
+    create (or add to) an indexed archive of files
+    members are stored by basename
+    returns the number of members in the archive
+    """
+    index = {}
+    names = set(os.path.basename(f) for f in files)
+    tmp = archive + '.tmp'
+    with open(tmp, 'wb') as out:
+        # keep whatever is already archived for this month
+        if os.path.isfile(archive):
+            old = read_index(archive)
+            if old is not None:
+                with open(archive, 'rb') as src:
+                    for name, (offset, length) in old.items():
+                        if name not in names:
+                            index[name] = (out.tell(), length)
+                            _copy_range(src, out, offset, length)
+            else:
+                # older single-stream archive, recompress it member by member
+                with tarfile.open(archive, 'r:gz') as tar:
+                    for member in tar:
+                        if member.isfile() and member.name not in names:
+                            offset = out.tell()
+                            length = _compress_member(out, member, tar.extractfile(member))
+                            index[member.name] = (offset, length)
+
+        for f in sorted(files):
+            st = os.stat(f)
+            tarinfo = tarfile.TarInfo(os.path.basename(f))
+            tarinfo.size = st.st_size
+            tarinfo.mtime = int(st.st_mtime)
+            tarinfo.mode = st.st_mode & 0o7777
+            with open(f, 'rb') as fp:
+                offset = out.tell()
+                length = _compress_member(out, tarinfo, fp)
+            index[tarinfo.name] = (offset, length)
+
+        # end-of-archive marker (two empty blocks) as a final gzip member
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        out.write(z.compress(tarfile.NUL * tarfile.BLOCKSIZE * 2) + z.flush())
+
+    os.replace(tmp, archive)
+    write_index(archive, index)
+    return len(index)
+
+
+def read_member(archive, name):
+    """
+    return the contents of one archived file (bytes),
+    or None if it isn't in the archive
+    """
+    index = read_index(archive)
+    if index is None:
+        # no index, fall back to a full scan
+        try:
+            with tarfile.open(archive, 'r:gz') as tar:
+                member = tar.getmember(name)
+                return tar.extractfile(member).read()
+        except (OSError, KeyError, tarfile.TarError):
+            return None
+
+    if name not in index:
+        return None
+
+    offset, length = index[name]
+    with open(archive, 'rb') as fp:
+        fp.seek(offset)
+        block = zlib.decompress(fp.read(length), 31)
+    with tarfile.open(fileobj=io.BytesIO(block), mode='r:') as tar:
+        member = tar.next()
+        return tar.extractfile(member).read()
+
+
+def archive_for(directory, prefix, day):
+    """ archive that holds a given day (YYYYMMDD), e.g. log201806.tar.gz """
+    return os.path.join(directory, prefix + day[:6] + '.tar.gz')
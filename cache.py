@@ -0,0 +1,122 @@
+""" LeeTV disk cache module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  cache.py
+#
+#  Size-bounded directory of generated media files
+#  (merged commercial breaks, transcodes, etc.)
+#
+#  Files are named by a hash of whatever they were made
+#  from.  Using a file bumps its mtime, and when the cache
+#  grows past its budget the least recently used files
+#  are deleted first.
+#
+import os
+import hashlib
+import threading
+
+
+def make_key(*parts):
+    """ stable cache key from strings/numbers """
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode('utf-8', errors='surrogateescape'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class DiskCache:
+    """ LeeTV disk cache class """
+
+    # where the files live
+    directory = ''
+    # size budget in bytes
+    budget = 0
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, ext):
+        """ where the file for key lives (whether or not it exists yet) """
+        return os.path.join(self.directory, key + ext)
+
+    def temp(self, key, ext):
+        """ scratch name to build a file under before commit() """
+        return os.path.join(self.directory, key + '.part' + ext)
+
+    def get(self, key, ext):
+        """ path of a cached file (marking it recently used), or None """
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def commit(self, tmp, key, ext, trim=True):
+        """
+        move a finished file into the cache and trim to budget
+        (trim=False leaves trimming to the caller, see trim)
+        """
+        path = self.path(key, ext)
+        os.replace(tmp, path)
+        if trim:
+            self.trim(keep=(path,))
+        return path
+
+    def size(self):
+        """ total bytes in the cache """
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    total += entry.stat().st_size
+        return total
+
+    def trim(self, keep=()):
+        """ delete least recently used files (other than those in keep) until we're under budget """
+        with self.lock:
+            files = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and '.part' not in entry.name:
+                        st = entry.stat()
+                        files.append((st.st_mtime, st.st_size, entry.path))
+                        total += st.st_size
+            files.sort()
+            removed = 0
+            for mtime, size, path in files:
+                if total <= self.budget:
+                    break
+                if path in keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                    removed += 1
+                except OSError:
+                    pass
+            return removed
@@ -0,0 +1,238 @@
+""" LeeTV media catalog module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  catalog.py
+#
+#  Per-file metadata that is too expensive to recompute
+#  (stream info, loudness, etc.), kept alongside the media
+#  lists in ~/.leetv/config/catalog.json.
+#
+#  Entries are keyed the same way as the media lists
+#  (url-quoted absolute path) and remember the size and
+#  mtime of the file they were measured from, so a
+#  replaced file is measured again.
+#
+import os
+import json
+import threading
+import subprocess
+import urllib.parse
+
+from leeutils import run
+
+
+# seconds of packets read to measure the keyframe interval
+GOP_WINDOW = 12
+
+
+def probe_media(path):
+    """
+    everything we want to know about a file from a single ffprobe run:
+      dur: duration (ms)
+      br:  overall bit rate (bits/s)
+      v:   video stream, e.g. 'h264/1280x720/yuv420p/25/1'
+      a:   audio streams, e.g. ['aac/48000/2']
+      gop: keyframe interval (seconds, from the first few seconds)
+    returns None if the file can't be probed
+    """
+    try:
+        result = run(['ffprobe', '-v', 'error',
+                      '-show_entries',
+                      'format=duration,bit_rate:'
+                      'stream=index,codec_type,codec_name,width,height,pix_fmt,'
+                      'r_frame_rate,sample_rate,channels:'
+                      'packet=stream_index,pts_time,flags',
+                      '-read_intervals', '%+{}'.format(GOP_WINDOW),
+                      '-print_format', 'json', path],
+                     timeout=60, stdout=subprocess.PIPE)
+        meta = json.loads(result.stdout.decode('utf-8', errors='replace'))
+        fmt = meta['format']
+    except (OSError, ValueError, KeyError, subprocess.TimeoutExpired):
+        return None
+
+    info = {'a': []}
+    try:
+        info['dur'] = int(round(float(fmt['duration']), 3) * 1000)
+    except (KeyError, ValueError):
+        return None
+    try:
+        info['br'] = int(fmt['bit_rate'])
+    except (KeyError, ValueError):
+        info['br'] = None
+
+    video = None
+    for st in meta.get('streams', []):
+        if st.get('codec_type') == 'video' and video is None:
+            video = st.get('index')
+            info['v'] = '{}/{}x{}/{}/{}'.format(st.get('codec_name'), st.get('width'), st.get('height'),
+                                               st.get('pix_fmt'), st.get('r_frame_rate'))
+        elif st.get('codec_type') == 'audio':
+            info['a'].append('{}/{}/{}'.format(st.get('codec_name'), st.get('sample_rate'), st.get('channels')))
+
+    keyframes = []
+    for pkt in meta.get('packets', []):
+        if pkt.get('stream_index') == video and 'K' in pkt.get('flags', ''):
+            try:
+                keyframes.append(float(pkt['pts_time']))
+            except (KeyError, ValueError):
+                pass
+    keyframes.sort()
+    gaps = sorted(b - a for a, b in zip(keyframes, keyframes[1:]))
+    info['gop'] = round(gaps[len(gaps) // 2], 3) if gaps else None
+    return info
+
+
+def signature(info):
+    """
+    summary of the audio/video streams from probe_media(), e.g.
+    'h264/1280x720/yuv420p/25/1|aac/48000/2'
+    files with equal signatures can be joined by stream copy
+    """
+    if not info:
+        return None
+    parts = ([info['v']] if info.get('v') else []) + info.get('a', [])
+    return '|'.join(parts) if parts else None
+
+
+class Catalog:
+    """ LeeTV media catalog class """
+
+    # abs path of catalog.json
+    filename = ''
+    # {name: {'size': n, 'mtime': n, ...}}
+    entries = None
+    # unsaved changes
+    dirty = False
+    # entries are updated from worker threads (probes run in parallel)
+    lock = None
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = os.path.join(os.getenv('HOME'), '.leetv', 'config', 'catalog.json')
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename, 'r') as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            pass
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name, field=None, default=None):
+        """ whole entry, or one field of it """
+        entry = self.entries.get(name)
+        if entry is None:
+            return default
+        if field is None:
+            return entry
+        return entry.get(field, default)
+
+    def fresh(self, name, st):
+        """ return the entry if it was recorded from this very file (os.stat result) """
+        entry = self.entries.get(name)
+        if entry and entry.get('size') == st.st_size and entry.get('mtime') == int(st.st_mtime):
+            return entry
+        return None
+
+    def update(self, name, st, **fields):
+        """ record fields for a file, starting over if the file has changed """
+        with self.lock:
+            entry = self.fresh(name, st)
+            if entry is None:
+                entry = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+                self.entries[name] = entry
+            entry.update(fields)
+            self.dirty = True
+        return entry
+
+    def gain(self, name):
+        """ playback gain in dB, or None if not measured """
+        return self.get(name, 'gain')
+
+    def media(self, name, probe=True):
+        """
+        stream metadata of a file (see probe_media), probing it if
+        needed (or returning None if probe is False)
+        """
+        path = urllib.parse.unquote(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self.fresh(name, st)
+        if entry is not None and 'dur' in entry:
+            return entry
+        if not probe:
+            return None
+        info = probe_media(path)
+        if info is None:
+            return None
+        return self.update(name, st, **info)
+
+    def breaks(self, name):
+        """
+        natural break points of a file (ms, from ltv-analyze), or None
+        if it hasn't been analyzed since it last changed
+        """
+        try:
+            st = os.stat(urllib.parse.unquote(name))
+        except OSError:
+            return None
+        entry = self.fresh(name, st)
+        return entry.get('breaks') if entry else None
+
+    def signature(self, name):
+        """ stream signature of a file, probing it if needed """
+        return signature(self.media(name))
+
+    def can_stream_copy(self, name, vcodecs=('h264',), acodecs=('aac',)):
+        """ can a file go into a stream as-is (no transcode)? """
+        info = self.media(name)
+        if not info or not info.get('v'):
+            return False
+        return (info['v'].split('/')[0] in vcodecs and
+                all(a.split('/')[0] in acodecs for a in info.get('a', [])))
+
+    def bitrate(self, name, probe=True):
+        """ overall bit rate of a file (bits/s), or None if unknown """
+        info = self.media(name, probe)
+        return info.get('br') if info else None
+
+    def readahead(self, name, seconds, probe=True):
+        """ bytes needed to buffer this many seconds of a file, or None if unknown """
+        br = self.bitrate(name, probe)
+        return int(br * seconds / 8) if br else None
+
+    def save(self):
+        """ write catalog.json (atomically) if anything changed """
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(self.entries, fp, separators=(',', ':'), sort_keys=True)
+            os.replace(tmp, self.filename)
+            self.dirty = False
@@ -0,0 +1,233 @@
+""" LeeTV resident daemon module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  daemon.py
+#
+#  leetv --daemon: one resident process instead of cron
+#
+#  Does the jobs of the old crontab on an asyncio scheduler:
+#
+#      00:00    build the new day and load it into the running
+#               player (no more killall mpv), then rotate logs
+#      hh:15    ltv-getnewsweather -w
+#      hh:45    ltv-getnewsweather -n
+#
+#  The media catalog and media lists stay in memory between
+#  days.  The player is started once with a control socket
+#  and restarted (at the right item) if it ever exits.  The
+#  day's timeline is published by the guide service (guide.py).
+#
+import os
+import sys
+import signal
+import asyncio
+import subprocess
+from datetime import datetime, timedelta
+
+from mpvipc import MpvIpc, MpvError
+from prefetch import read_timeline, current_position
+
+# (minute past the hour, ltv-getnewsweather arguments)
+NEWSWEATHER = ((15, ['-w']), (45, ['-n']))
+# how often to check on the player (seconds)
+WATCHDOG = 30
+
+
+def seconds_until(hour=None, minute=0, second=0):
+    """ seconds until the next hh:mm:ss (or mm:ss past any hour if hour is None) """
+    now = datetime.now()
+    target = now.replace(minute=minute, second=second, microsecond=0)
+    if hour is not None:
+        target = target.replace(hour=hour)
+        step = timedelta(days=1)
+    else:
+        step = timedelta(hours=1)
+    while target <= now:
+        target += step
+    return (target - now).total_seconds()
+
+
+class Daemon:
+    """ LeeTV resident daemon class """
+
+    log = None
+    # ~/.leetv
+    directory = ''
+    # build(today, offset_s) -> (playlist, timeline), makes the day's playlist
+    build = None
+    # start(playlist, ipc) -> Popen or None, launches the player
+    start = None
+    # current playlist/timeline
+    playlist = ''
+    timeline = ''
+
+    def __init__(self, log, directory, build, start, reopen_log, guide=None):
+        self.log = log
+        self.directory = directory
+        self.build = build
+        self.start = start
+        self.reopen_log = reopen_log
+        # guide.GuideServer publishing the current timeline (optional)
+        self.guide = guide
+        self.mpv = MpvIpc(os.path.join(directory, 'mpv.sock'))
+        self.proc = None
+        self.stopping = None
+
+    def tool(self, name):
+        """ path of one of the ltv-* programs """
+        return os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), name)
+
+    async def make_day(self, offset_s):
+        """ build today's playlist in a worker thread, returns True if it worked """
+        today = datetime.now().strftime('%Y%m%d')
+        loop = asyncio.get_running_loop()
+        try:
+            self.playlist, self.timeline = await loop.run_in_executor(None, self.build, today, offset_s)
+        except (Exception, SystemExit) as e:  # pylint: disable=W0703
+            # log.error() exits, which mustn't take the daemon down with it
+            self.log.warning('Playlist build failed: {}'.format(e))
+            return False
+        if self.guide:
+            self.guide.load(self.timeline)
+        return True
+
+    async def start_player(self):
+        """ start the player without blocking the scheduler (or the guide) """
+        await asyncio.get_running_loop().run_in_executor(None, self.launch_player)
+
+    def launch_player(self):
+        """ start the player on the current playlist, joining it at the current item (blocks) """
+        self.proc = self.start(self.playlist, self.mpv.path)
+        if self.proc is None or not self.mpv.wait():
+            return
+        position = self.current_position()
+        try:
+            if position is None:
+                # nothing left today, idle until midnight brings a new playlist
+                self.log.info('Playlist has ended for today')
+                self.mpv.command('stop')
+            elif position != (0, 0):
+                self.mpv.join(position[0], position[1] / 1000)
+        except MpvError as e:
+            self.log.warning('Unable to join the playlist at {}: {}'.format(position, e))
+
+    def current_position(self):
+        """ (index, ms into it) of the playlist item that should be on air now, None if the day is over """
+        try:
+            timeline = read_timeline(self.timeline)
+        except (OSError, ValueError):
+            return 0, 0
+        now = datetime.now()
+        return current_position(timeline, (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds() * 1000)
+
+    async def swap(self):
+        """ load the new playlist into the running player """
+        try:
+            self.mpv.command('script-message', 'leetv-gain-playlist', self.playlist)
+            self.mpv.loadlist(self.playlist)
+            self.log.info('Loaded {} into the running player'.format(self.playlist))
+        except MpvError as e:
+            self.log.warning('Unable to reach the player ({}), restarting it'.format(e))
+            await asyncio.get_running_loop().run_in_executor(None, self.stop_player)
+            await self.start_player()
+
+    def stop_player(self):
+        """ stop the player we started """
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+    async def run_tool(self, name, *args):
+        """ run one of the ltv-* programs without blocking the scheduler """
+        try:
+            proc = await asyncio.create_subprocess_exec(sys.executable, self.tool(name), *args,
+                                                        stdin=subprocess.DEVNULL,
+                                                        stdout=subprocess.DEVNULL,
+                                                        stderr=subprocess.PIPE)
+            _, err = await proc.communicate()
+        except OSError as e:
+            self.log.warning('Unable to run {}: {}'.format(name, e))
+            return
+        if proc.returncode:
+            self.log.warning('{} {} failed: {}'.format(
+                name, ' '.join(args), err.decode('utf-8', errors='replace').strip()[-200:]))
+        else:
+            self.log.info('{} {} done'.format(name, ' '.join(args)))
+
+    async def midnight(self):
+        """ new log, new playlist and log rotation every day at midnight """
+        while True:
+            await asyncio.sleep(seconds_until(0, 0, 1))
+            self.reopen_log(datetime.now().strftime('%Y%m%d'))
+            if await self.make_day(0) and self.proc is not None:
+                await self.swap()
+            await self.run_tool('ltv-logrotate')
+
+    async def newsweather(self, minute, args):
+        """ refresh the news or weather video every hour """
+        while True:
+            await asyncio.sleep(seconds_until(None, minute))
+            await self.run_tool('ltv-getnewsweather', *args)
+
+    async def watchdog(self):
+        """ restart the player if it exits """
+        while True:
+            await asyncio.sleep(WATCHDOG)
+            if self.proc is not None and self.proc.poll() is not None:
+                self.log.warning('Player exited ({}), restarting'.format(self.proc.returncode))
+                await self.start_player()
+
+    async def main(self):
+        """ run until SIGTERM/SIGINT """
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        if self.guide:
+            self.guide.start()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        if not await self.make_day(None):
+            self.log.error('Unable to build the first playlist')
+        await self.start_player()
+
+        tasks = [asyncio.ensure_future(self.midnight()),
+                 asyncio.ensure_future(self.watchdog())]
+        tasks += [asyncio.ensure_future(self.newsweather(minute, args)) for minute, args in NEWSWEATHER]
+        self.log.info('Daemon running (pid {})'.format(os.getpid()))
+
+        await self.stopping.wait()
+        self.log.info('Daemon stopping')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.guide:
+            self.guide.stop()
+        self.stop_player()
+
+    def run(self):
+        """ entry point """
+        asyncio.run(self.main())
+        return 0
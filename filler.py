@@ -0,0 +1,131 @@
+""" LeeTV exact-length filler module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  filler.py
+#
+#  Fill video of any length (leetv --exact-fill)
+#
+#  The first SEGMENT seconds of the fill video are encoded
+#  once as a closed-GOP segment (starts on a keyframe, never
+#  refers outside itself), so it can be repeated back to back
+#  by stream copy.  A filler of a given length is then just
+#  that segment looped and cut, which takes ffmpeg a few
+#  milliseconds of CPU instead of a full encode.
+#
+#  Lengths are rounded down to whole seconds (BUCKET) so a
+#  handful of fillers cover a whole day, and each one is kept
+#  in ~/.leetv/cache/filler.  A new fill video (different
+#  size/mtime) starts everything over.
+#
+import os
+import subprocess
+
+from leeutils import run
+from cache import DiskCache, make_key
+
+# length of the looped segment (seconds)
+SEGMENT = 30
+# fillers come in multiples of this (ms)
+BUCKET = 1000
+# bump this when the encode below changes
+PROFILE = 'fill-v1'
+# frame rate of the segment (a still picture doesn't need more)
+FPS = 25
+# longest an ffmpeg run may take (seconds)
+TIMEOUT = 600
+
+
+class Filler:
+    """ LeeTV exact-length filler class """
+
+    log = None
+    # source video (absolute path)
+    source = ''
+    # cache.DiskCache holding the segment and the fillers
+    cache = None
+
+    def __init__(self, log, source, directory, budget):
+        self.log = log
+        self.source = source
+        self.cache = DiskCache(directory, budget)
+        st = os.stat(source)
+        self.stamp = (source, st.st_size, int(st.st_mtime), PROFILE)
+        self.made = 0
+
+    def ffmpeg(self, args, tmp):
+        """ run ffmpeg into a cache temp file, True if it worked """
+        try:
+            returncode = run(['ffmpeg', '-v', 'error', '-nostdin', '-y'] + args + [tmp],
+                             timeout=TIMEOUT).returncode
+        except (OSError, subprocess.TimeoutExpired):
+            returncode = -1
+        if returncode:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def segment(self):
+        """ path of the loopable segment, encoding it if needed (None if that fails) """
+        key = make_key(*self.stamp)
+        path = self.cache.get(key, '.mp4')
+        if path:
+            return path
+        self.log.info('Encoding {}s filler segment from {}'.format(SEGMENT, self.source))
+        tmp = self.cache.temp(key, '.mp4')
+        # keyframe only at the start (closed GOP), fixed audio
+        # format so every repeat joins cleanly
+        if not self.ffmpeg(['-i', self.source, '-t', str(SEGMENT),
+                            '-map', '0:v:0', '-map', '0:a:0?',
+                            '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                            '-r', str(FPS), '-g', str(SEGMENT * FPS), '-keyint_min', str(SEGMENT * FPS),
+                            '-sc_threshold', '0', '-flags', '+cgop',
+                            '-c:a', 'aac', '-b:a', '128k', '-ar', '48000', '-ac', '2',
+                            '-movflags', '+faststart'], tmp):
+            self.log.warning('Unable to encode a filler segment from {}'.format(self.source))
+            return None
+        return self.cache.commit(tmp, key, '.mp4')
+
+    def get(self, ms):
+        """ (path, length in ms) of a filler no longer than ms, or (None, 0) """
+        length = int(ms) // BUCKET * BUCKET
+        if length <= 0:
+            return None, 0
+        key = make_key(*self.stamp, length)
+        path = self.cache.get(key, '.mp4')
+        if path:
+            return path, length
+
+        segment = self.segment()
+        if segment is None:
+            return None, 0
+        loops = -(-length // (SEGMENT * 1000)) - 1
+        tmp = self.cache.temp(key, '.mp4')
+        if not self.ffmpeg(['-stream_loop', str(loops), '-i', segment,
+                            '-t', '{:.3f}'.format(length / 1000),
+                            '-c', 'copy', '-movflags', '+faststart'], tmp):
+            self.log.warning('Unable to make a {:.0f}s filler'.format(length / 1000))
+            return None, 0
+        self.made += 1
+        return self.cache.commit(tmp, key, '.mp4'), length
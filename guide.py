@@ -0,0 +1,204 @@
+""" LeeTV program guide module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  guide.py
+#
+#  What's on: answers now/next/guide queries from the day's
+#  built timeline (not the schedule), over a tiny HTTP
+#  service that leetv runs while it's resident:
+#
+#      /now                   item on air
+#      /next?n=3              the next n items
+#      /guide?from=2000&to=2300&shows=1
+#                             items airing between two times
+#                             (shows=1 leaves out commercials)
+#
+#  Replies are JSON lists of items:
+#
+#      {"start": ms, "length": ms, "time": "hh:mm:ss",
+#       "series": ..., "title": ..., "path": ...}
+#
+import os
+import json
+import bisect
+import threading
+import urllib.parse
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from prefetch import read_timeline, clock
+
+# default port for the guide service
+PORT = 8081
+# series that aren't shows
+NOT_SHOWS = (None, 'Commercial', 'Break')
+
+
+def now_ms():
+    """ ms since midnight """
+    now = datetime.now()
+    return (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds() * 1000
+
+
+def parse_time(value):
+    """ 'now', 'hhmm' or 'hh:mm' as ms since midnight """
+    if value == 'now':
+        return now_ms()
+    value = value.replace(':', '')
+    if len(value) != 4 or not value.isdigit():
+        raise ValueError('bad time: {}'.format(value))
+    return (int(value[:2]) * 60 + int(value[2:])) * 60 * 1000
+
+
+class Guide:
+    """ LeeTV program guide class """
+
+    # (item dicts, their start times (sorted)), replaced as a whole
+    # so a query never sees the items of one timeline and the
+    # start times of another
+    index = ((), ())
+
+    def __init__(self, timeline=()):
+        self.index = ([], [])
+        self.set_timeline(timeline)
+
+    def set_timeline(self, timeline):
+        """ index a timeline (see prefetch.read_timeline) """
+        items = []
+        for start_ms, length_ms, series, name in sorted(timeline):
+            path = urllib.parse.unquote(name)
+            items.append({'start': start_ms,
+                          'length': length_ms,
+                          'time': clock(start_ms),
+                          'series': series,
+                          'title': os.path.splitext(os.path.basename(path))[0],
+                          'path': path})
+        # one store, queries may be running
+        self.index = (items, [item['start'] for item in items])
+
+    def load(self, filename):
+        """ index a timeline file """
+        self.set_timeline(read_timeline(filename))
+
+    def index_at(self, ms, index=None):
+        """ index of the item on air at ms, or -1 (in index, default the current one) """
+        items, starts = index or self.index
+        i = bisect.bisect_right(starts, ms) - 1
+        if i >= 0 and ms < items[i]['start'] + items[i]['length']:
+            return i
+        return -1
+
+    def now(self, ms=None):
+        """ item on air (list of one, or empty) """
+        index = self.index
+        i = self.index_at(now_ms() if ms is None else ms, index)
+        return [index[0][i]] if i >= 0 else []
+
+    def next(self, n=1, ms=None, shows=False):
+        """ the next n items after the one on air """
+        ms = now_ms() if ms is None else ms
+        items, starts = self.index
+        i = bisect.bisect_right(starts, ms)
+        found = []
+        while i < len(items) and len(found) < n:
+            if not shows or items[i]['series'] not in NOT_SHOWS:
+                found.append(items[i])
+            i += 1
+        return found
+
+    def range(self, start_ms, end_ms, shows=False):
+        """ items on air at any time between start_ms and end_ms """
+        items, starts = self.index
+        i = max(bisect.bisect_right(starts, start_ms) - 1, 0)
+        j = bisect.bisect_left(starts, end_ms)
+        found = []
+        for item in items[i:j]:
+            if item['start'] + item['length'] <= start_ms:
+                continue
+            if not shows or item['series'] not in NOT_SHOWS:
+                found.append(item)
+        return found
+
+
+class GuideHandler(BaseHTTPRequestHandler):
+    """ answer guide queries """
+
+    guide = None
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+    def do_GET(self):  # pylint: disable=C0111
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        shows = query.get('shows', '0') == '1'
+        try:
+            if url.path == '/now':
+                reply = self.guide.now()
+            elif url.path == '/next':
+                reply = self.guide.next(int(query.get('n', 1)), shows=shows)
+            elif url.path == '/guide':
+                reply = self.guide.range(parse_time(query.get('from', 'now')),
+                                         parse_time(query.get('to', '2400')), shows=shows)
+            else:
+                self.send_error(404)
+                return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        body = json.dumps(reply).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GuideServer:
+    """ LeeTV program guide service class """
+
+    log = None
+    guide = None
+
+    def __init__(self, log, host='127.0.0.1', port=PORT):
+        self.log = log
+        self.guide = Guide()
+        handler = type('Handler', (GuideHandler,), {'guide': self.guide})
+        self.server = ThreadingHTTPServer((host, port), handler)
+
+    def start(self):
+        """ serve in the background """
+        threading.Thread(target=self.server.serve_forever, name='guide', daemon=True).start()
+        host, port = self.server.server_address[:2]
+        self.log.info('Guide at http://{}:{}/now'.format(host, port))
+
+    def load(self, filename):
+        """ publish a new day's timeline """
+        try:
+            self.guide.load(filename)
+        except (OSError, ValueError) as e:
+            self.log.warning('Unable to read timeline {}: {}'.format(filename, e))
+
+    def stop(self):
+        """ stop serving """
+        self.server.shutdown()
+        self.server.server_close()
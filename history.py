@@ -0,0 +1,225 @@
+""" LeeTV airing history module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  history.py
+#
+#  What aired when, in ~/.leetv/history
+#
+#  One row per aired item, stored as columns of fixed size
+#  numbers so a year of history loads in a few milliseconds:
+#
+#      dates.u32     YYYYMMDD
+#      offsets.u32   ms since midnight
+#      series.u16    id of the series (line in series.txt)
+#      media.u32     id of the video (line in media.txt)
+#
+#  Videos are identified by their quoted path (the same name
+#  the media lists use), series by their schedule name.  Rows
+#  backfilled from old logs only have the file name, so lookups
+#  by path fall back to that.  Rows are kept in air order.
+#
+import os
+import array
+import urllib.parse
+
+# columns: name, array typecode, file extension
+COLUMNS = (('dates', 'I', '.u32'), ('offsets', 'I', '.u32'), ('series', 'H', '.u16'), ('media', 'I', '.u32'))
+
+
+class History:
+    """ LeeTV airing history class """
+
+    # where the column files live
+    directory = ''
+
+    def __init__(self, directory=None):
+        if not directory:
+            directory = os.path.join(os.getenv('HOME'), '.leetv', 'history')
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def _column(self, name):
+        ext = [c[2] for c in COLUMNS if c[0] == name][0]
+        return os.path.join(self.directory, name + ext)
+
+    def _strings(self, name):
+        return os.path.join(self.directory, name + '.txt')
+
+    def load(self):
+        """ read the whole store into memory and index it """
+        self.cols = {}
+        for name, code, _ in COLUMNS:
+            col = array.array(code)
+            try:
+                with open(self._column(name), 'rb') as fp:
+                    col.frombytes(fp.read())
+            except OSError:
+                pass
+            self.cols[name] = col
+        # an interrupted append can leave the columns uneven
+        rows = min(len(c) for c in self.cols.values())
+        for col in self.cols.values():
+            del col[rows:]
+
+        self.series_names = self._read_strings('series')
+        self.media_names = self._read_strings('media')
+        self.series_ids = {s: i for i, s in enumerate(self.series_names)}
+        self.media_ids = {m: i for i, m in enumerate(self.media_names)}
+        self._index()
+
+    def _index(self):
+        """ remember the last row each video aired in """
+        self.last = {}
+        for row, media in enumerate(self.cols['media']):
+            self.last[media] = row
+
+    def _read_strings(self, name):
+        try:
+            with open(self._strings(name), 'r') as fp:
+                return [line.rstrip('\n') for line in fp]
+        except OSError:
+            return []
+
+    def __len__(self):
+        return len(self.cols['dates'])
+
+    def _id(self, kind, value):
+        """ id of a series/media name, adding it to the string table if new """
+        ids = self.series_ids if kind == 'series' else self.media_ids
+        names = self.series_names if kind == 'series' else self.media_names
+        if value not in ids:
+            ids[value] = len(names)
+            names.append(value)
+            with open(self._strings(kind), 'a') as fp:
+                fp.write(value + '\n')
+        return ids[value]
+
+    def _write(self, start):
+        """ rewrite the column files from row 'start' on """
+        for name, _, _ in COLUMNS:
+            with open(self._column(name), 'r+b' if os.path.exists(self._column(name)) else 'wb') as fp:
+                col = self.cols[name]
+                fp.seek(start * col.itemsize)
+                fp.truncate()
+                fp.write(col[start:].tobytes())
+
+    def append(self, rows):
+        """
+        record aired items: [(YYYYMMDD, offset_ms, series, media)] in air order
+        anything already recorded from the first new item on is replaced
+        (leetv run twice in a day doesn't count the rest of the day twice)
+        """
+        if not rows:
+            return
+        first = (int(rows[0][0]), int(rows[0][1]))
+        dates, offsets = self.cols['dates'], self.cols['offsets']
+        start = len(dates)
+        while start > 0 and (dates[start - 1], offsets[start - 1]) >= first:
+            start -= 1
+        for col in self.cols.values():
+            del col[start:]
+        for day, offset, series, media in rows:
+            self.cols['dates'].append(int(day))
+            self.cols['offsets'].append(int(offset))
+            self.cols['series'].append(self._id('series', series))
+            self.cols['media'].append(self._id('media', media))
+        self._write(start)
+        self._index()
+
+    def replace(self, rows):
+        """ rewrite the whole store from [(YYYYMMDD, offset_ms, series, media)] (any order) """
+        for col in self.cols.values():
+            del col[:]
+        self._index()
+        self.append(sorted(rows, key=lambda r: (int(r[0]), int(r[1]))))
+        if not rows:
+            self._write(0)
+
+    def rows(self):
+        """ every row as (YYYYMMDD, offset_ms, series, media) """
+        cols = self.cols
+        for i in range(len(self)):
+            yield (cols['dates'][i], cols['offsets'][i],
+                   self.series_names[cols['series'][i]], self.media_names[cols['media'][i]])
+
+    def days(self):
+        """ set of dates with history """
+        return set(self.cols['dates'])
+
+    def first_day(self):
+        """ YYYYMMDD of the oldest row, or None """
+        return self.cols['dates'][0] if len(self) else None
+
+    def _ids(self, media):
+        """ ids a video may be recorded under: its quoted path and, for old log rows, its file name """
+        names = (media, os.path.basename(urllib.parse.unquote(media)))
+        return {self.media_ids[m] for m in names if m in self.media_ids}
+
+    def last_aired(self, media):
+        """ (YYYYMMDD, offset_ms) a video last aired, or None """
+        rows = [self.last[i] for i in self._ids(media) if i in self.last]
+        if not rows:
+            return None
+        row = max(rows)
+        return self.cols['dates'][row], self.cols['offsets'][row]
+
+    def last_aired_before(self, media, day, offset_ms):
+        """
+        {video: (YYYYMMDD, offset_ms)} when each of the videos in media
+        last aired before day/offset_ms (videos that hadn't aired are left out)
+        """
+        wanted = {}
+        for m in media:
+            for i in self._ids(m):
+                wanted.setdefault(i, []).append(m)
+        dates, offsets, ids = self.cols['dates'], self.cols['offsets'], self.cols['media']
+        before = (int(day), int(offset_ms))
+        found = {}
+        # rows are in air order, walk back from the end
+        i = len(dates) - 1
+        while i >= 0 and (dates[i], offsets[i]) >= before:
+            i -= 1
+        while i >= 0 and wanted:
+            if ids[i] in wanted:
+                for m in wanted.pop(ids[i]):
+                    found.setdefault(m, (dates[i], offsets[i]))
+            i -= 1
+        return found
+
+    def aired_since(self, series, day):
+        """
+        set of videos of a series that aired on or after day (YYYYMMDD)
+        (quoted paths, or file names for rows from old logs)
+        """
+        sid = self.series_ids.get(series)
+        if sid is None:
+            return set()
+        dates, ser, media = self.cols['dates'], self.cols['series'], self.cols['media']
+        found = set()
+        # rows are in date order, walk back from the end
+        i = len(dates) - 1
+        while i >= 0 and dates[i] >= int(day):
+            if ser[i] == sid:
+                found.add(self.media_names[media[i]])
+            i -= 1
+        return found
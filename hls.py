@@ -0,0 +1,226 @@
+""" LeeTV HLS channel module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  hls.py
+#
+#  Turn the day's playlist into one continuous HLS channel
+#
+#  Each playlist item is fed through ffmpeg in real time and
+#  appended to a single live HLS playlist (channel.m3u8), with
+#  a discontinuity marker between items.  Items that are
+#  already H.264/AAC are stream copied; anything else is
+#  transcoded.  The segments are served by a small built-in
+#  HTTP server, so any number of clients on the network can
+#  watch for the cost of (at most) one encode:
+#
+#      mpv http://leetvbox:8080/channel.m3u8
+#
+import os
+import time
+import socket
+import threading
+import subprocess
+import functools
+import urllib.parse
+from datetime import datetime
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from prefetch import read_timeline
+
+# length of each HLS segment (seconds)
+SEGMENT = 4
+# number of segments in the live playlist
+LIST_SIZE = 15
+
+# stream profile for items that can't be copied
+TRANSCODE = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+             '-g', str(SEGMENT * 25), '-c:a', 'aac', '-b:a', '128k', '-ac', '2']
+COPY = ['-c', 'copy']
+
+
+def read_playlist(filename):
+    """
+    read an m3u8 playlist written by leetv, returns ([names], [times], start_ms)
+    the lengths and start come from the timeline next to it, if there is one
+    (#EXTINF only has whole seconds), otherwise the playlist runs up to midnight
+    """
+    names = []
+    times = []
+    length = 0
+    with open(filename, 'r') as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if line.startswith('#EXTINF:'):
+                length = int(float(line[8:].split(',')[0]) * 1000)
+            elif line and not line.startswith('#'):
+                names.append(urllib.parse.quote(line))
+                times.append(str(length))
+    try:
+        timeline = read_timeline(os.path.splitext(filename)[0] + '.tl')
+    except (OSError, ValueError):
+        timeline = []
+    if timeline and len(timeline) == len(times):
+        times = [str(length_ms) for start_ms, length_ms, series, name in timeline]
+        return names, times, timeline[0][0]
+    return names, times, 24 * 60 * 60 * 1000 - sum(int(t) for t in times)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """ static file handler that doesn't log every request to stderr """
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+    def end_headers(self):
+        # the live playlist changes every few seconds
+        if self.path.endswith('.m3u8'):
+            self.send_header('Cache-Control', 'no-cache')
+        super().end_headers()
+
+
+class HlsChannel:
+    """ LeeTV HLS channel class """
+
+    # output directory for channel.m3u8 and segments
+    directory = ''
+    # HTTP port
+    port = 8080
+    log = None
+    catalog = None
+    # optional ahead-of-air transcoder (transcode.Pretranscoder)
+    pretranscoder = None
+
+    def __init__(self, log, directory, port, catalog, pretranscoder=None):
+        self.log = log
+        self.directory = directory
+        self.port = port
+        self.catalog = catalog
+        self.pretranscoder = pretranscoder
+        self.server = None
+        os.makedirs(directory, exist_ok=True)
+        # start every day with a clean channel
+        for f in os.listdir(directory):
+            if f.endswith('.ts') or f.endswith('.m3u8'):
+                os.remove(os.path.join(directory, f))
+
+    def serve(self):
+        """ start the HTTP server in the background """
+        handler = functools.partial(QuietHandler, directory=self.directory)
+        self.server = ThreadingHTTPServer(('', self.port), handler)
+        threading.Thread(target=self.server.serve_forever, name='hls-http', daemon=True).start()
+        self.log.info('HLS channel at http://{}:{}/channel.m3u8'.format(socket.gethostname(), self.port))
+
+    def stop(self):
+        """ stop the HTTP server """
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+    def input_args(self, path, seek_s):
+        """ ffmpeg input arguments for one playlist item """
+        args = ['-re']
+        if seek_s > 0:
+            args += ['-ss', '{:.3f}'.format(seek_s)]
+        if path.endswith('.ffconcat'):
+            args += ['-f', 'concat', '-safe', '0']
+        return args + ['-i', path]
+
+    def codec_args(self, name):
+        """ copy if the item is already H.264/AAC, otherwise transcode """
+        if name.endswith('.ffconcat'):
+            # merged breaks only contain matching items, check the first one
+            with open(urllib.parse.unquote(name), 'r') as fp:
+                for line in fp:
+                    if line.startswith('file '):
+                        name = urllib.parse.quote(line[6:-2].replace("'\\''", "'"))
+                        break
+        return COPY if self.catalog.can_stream_copy(name) else TRANSCODE
+
+    def play_item(self, n, name, seek_s):
+        """ push one item into the channel in real time """
+        path = urllib.parse.unquote(name)
+        codec = None
+        if self.pretranscoder and not name.endswith('.ffconcat'):
+            cached = self.pretranscoder.lookup(name)
+            if cached:
+                # already in the stream profile, just copy it
+                path, codec = cached, COPY
+        if codec is None:
+            codec = self.codec_args(name)
+        cmd = (['ffmpeg', '-v', 'error', '-nostdin'] +
+               self.input_args(path, seek_s) +
+               ['-map', '0:v:0', '-map', '0:a:0?'] +
+               codec +
+               ['-f', 'hls',
+                '-hls_time', str(SEGMENT),
+                '-hls_list_size', str(LIST_SIZE),
+                '-hls_flags', 'append_list+omit_endlist+discont_start+program_date_time',
+                '-hls_segment_filename', os.path.join(self.directory, 'item{:04d}_%05d.ts'.format(n)),
+                os.path.join(self.directory, 'channel.m3u8')])
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode:
+            self.log.warning('HLS: unable to stream {}: {}'.format(
+                path, result.stderr.decode('utf-8', errors='replace').strip()[-200:]))
+        self.cleanup()
+
+    def cleanup(self):
+        """ delete segments that have dropped off the live playlist """
+        try:
+            with open(os.path.join(self.directory, 'channel.m3u8'), 'r') as fp:
+                live = set(line.strip() for line in fp if line.endswith('.ts\n'))
+        except OSError:
+            return
+        for f in os.listdir(self.directory):
+            if f.endswith('.ts') and f not in live:
+                try:
+                    os.remove(os.path.join(self.directory, f))
+                except OSError:
+                    pass
+
+    def run(self, names, times, start_ms):
+        """
+        stream the timeline (names/times starting at start_ms since midnight)
+        keeping to the wall clock: items that are already over are skipped
+        and an item that is under way is joined in the middle
+        """
+        self.serve()
+        if self.pretranscoder:
+            self.pretranscoder.start(names, times, start_ms)
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        item_start_ms = start_ms
+        try:
+            for n, (name, length) in enumerate(zip(names, times)):
+                item_end_ms = item_start_ms + int(length)
+                now_ms = (datetime.now() - midnight).total_seconds() * 1000
+                if now_ms < item_end_ms - 1000:
+                    if now_ms < item_start_ms:
+                        # early, wait for air time
+                        time.sleep((item_start_ms - now_ms) / 1000)
+                        now_ms = item_start_ms
+                    self.log.debug('HLS: %s', os.path.basename(urllib.parse.unquote(name)))
+                    self.play_item(n, name, (now_ms - item_start_ms) / 1000)
+                item_start_ms = item_end_ms
+        finally:
+            if self.pretranscoder:
+                self.pretranscoder.stop()
+            self.stop()
+            self.catalog.save()
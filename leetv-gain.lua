@@ -0,0 +1,72 @@
+-- leetv-gain.lua
+--
+-- mpv script used by leetv to apply the per-item playback
+-- gain measured by ltv-loudness.  leetv writes the gain into
+-- the m3u8 playlist as '#EXTVLCOPT:gain=<factor>' (which VLC
+-- understands natively); mpv ignores those lines, so this
+-- script reads them and sets a volume filter for each file.
+--
+-- It also picks up '#LEETV:readahead=<bytes>', the demuxer
+-- buffer leetv sized from each file's bit rate, so high
+-- bit rate files get a deeper buffer than mpv's default
+-- (only files that need more than that have one).
+--
+-- Started by leetv with:
+--   --script=leetv-gain.lua --script-opts=leetv-gain-playlist=<playlist>
+
+local options = { playlist = "" }
+require("mp.options").read_options(options, "leetv-gain")
+
+local gains = {}
+local readahead = {}
+
+local function load(playlist)
+    local f = io.open(playlist, "r")
+    if not f then
+        return
+    end
+    local pending = nil
+    local bytes = nil
+    for line in f:lines() do
+        local g = line:match("^#EXTVLCOPT:gain=([0-9.]+)")
+        local r = line:match("^#LEETV:readahead=([0-9]+)")
+        if g then
+            pending = g
+        elseif r then
+            bytes = r
+        elseif line ~= "" and line:sub(1, 1) ~= "#" then
+            if pending then
+                gains[line] = pending
+            end
+            if bytes then
+                readahead[line] = bytes
+            end
+            pending = nil
+            bytes = nil
+        end
+    end
+    f:close()
+end
+
+if options.playlist ~= "" then
+    load(options.playlist)
+end
+
+-- leetv --daemon loads each new day's playlist into the running
+-- player and sends 'script-message leetv-gain-playlist <playlist>'
+mp.register_script_message("leetv-gain-playlist", function(playlist)
+    gains = {}
+    readahead = {}
+    load(playlist)
+end)
+
+mp.add_hook("on_load", 50, function()
+    local g = gains[mp.get_property("path")]
+    if g then
+        mp.set_property("file-local-options/af", "lavfi=[volume=" .. g .. "]")
+    end
+    local r = readahead[mp.get_property("path")]
+    if r then
+        mp.set_property("file-local-options/demuxer-max-bytes", r)
+    end
+end)
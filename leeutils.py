@@ -29,7 +29,23 @@
 import os
 import sys
 import re
+import random
+import time
+import shutil
+import importlib.util
 import subprocess
+import threading
+import queue
+import atexit
+
+# external programs run at once by run(), across all threads
+RUN_LIMIT = max(os.cpu_count() or 1, 2)
+_run_slots = threading.BoundedSemaphore(RUN_LIMIT)
+# {program: [runs, failed, timed out, total seconds, longest]}
+_run_stats = {}
+_run_lock = threading.Lock()
+# {program: path or None}
+_which_cache = {}
 
 
 def unique(items):
@@ -91,6 +107,59 @@ def natural_sort(x):
     return [int(y) if y.isdigit() else y for y in re.split(r'(\d+)', x)]
 
 
+def lazy_import(name):
+    '''
+    Import a module the first time one of its
+    attributes is used, so tools don't pay for
+    dependencies a particular run never touches.
+    Returns None if the module isn't installed.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError:
+        return None
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def read_medialist(filename, shuffle=False):
+    '''
+    Parse a media list ('name : ms' lines, names
+    url-quoted) into ([names], [times]).
+    Raises OSError if it can't be read.
+    '''
+    with open(filename, 'r') as fp:
+        lines = fp.read().splitlines()
+    if shuffle:
+        random.shuffle(lines)
+    f = []
+    t = []
+    for line in lines:
+        # names are quoted, so the last ':' is the separator
+        a, sep, b = line.rpartition(':')
+        if sep:
+            f.append(a.strip())
+            t.append(b.strip())
+    return f, t
+
+
+def get_filelist(filename, shuffle=False):
+    """ get media file list by filename, optionally shuffled (exits if it's missing) """
+    try:
+        return read_medialist(filename, shuffle)
+    except OSError:
+        print('{} does not exist!'.format(filename))
+        sys.exit(1)
+
+
 def makepath(*paths):
     '''
     Convenience function for creating a path
@@ -152,9 +221,75 @@ def which(program):
     '''
     Find 'program' in path,
     return location as path
+    (looked up once per process)
+    '''
+    if program not in _which_cache:
+        _which_cache[program] = shutil.which(program)
+    return _which_cache[program]
+
+
+def _record(program, seconds, returncode):
+    ''' add one run to the per-program numbers '''
+    with _run_lock:
+        stats = _run_stats.setdefault(program, [0, 0, 0, 0.0, 0.0])
+        stats[0] += 1
+        if returncode is None:
+            stats[2] += 1
+        elif returncode:
+            stats[1] += 1
+        stats[3] += seconds
+        stats[4] = max(stats[4], seconds)
+
+
+def run(args, timeout=None, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, **kwargs):
     '''
-    o, e, ret = call(['which', program])
-    return None if ret else o.rstrip()
+    Run a program to completion, no shell.
+    Takes a list of strings like ['ffprobe', '-v', 'error', file],
+    waits for one of RUN_LIMIT slots and returns the
+    subprocess.CompletedProcess.  Raises subprocess.TimeoutExpired
+    (after killing it) if it takes longer than timeout seconds,
+    and OSError if it can't be started.
+    Every run is counted (see log_runs).
+    '''
+    program = os.path.basename(args[0])
+    args = [which(args[0]) or args[0]] + list(args[1:])
+    with _run_slots:
+        start = time.time()
+        try:
+            result = subprocess.run(args, timeout=timeout, stdin=stdin, stdout=stdout,
+                                    stderr=stderr, **kwargs)
+        except subprocess.TimeoutExpired:
+            _record(program, time.time() - start, None)
+            raise
+        except OSError:
+            _record(program, time.time() - start, -1)
+            raise
+    _record(program, time.time() - start, result.returncode)
+    return result
+
+
+def spawn(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL, **kwargs):
+    '''
+    Start a program in the background, no shell
+    (players and the like, they don't take a run() slot).
+    Returns the subprocess.Popen.
+    '''
+    args = [which(args[0]) or args[0]] + list(args[1:])
+    return subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+
+
+def log_runs(log):
+    '''
+    Write what run() did to the log,
+    one line per program
+    '''
+    with _run_lock:
+        stats = sorted(_run_stats.items())
+    for program, (runs, failed, timedout, seconds, longest) in stats:
+        log.info('Ran {}: {} times, {} failed, {} timed out, {:.2f}s total, {:.2f}s longest'.format(
+            program, runs, failed, timedout, seconds, longest))
 
 
 def rename_ini_section(cp, section_from, section_to):
@@ -286,6 +421,9 @@ class Log:
     f = sys.stdout
     both = False
     level = levels['INFO']
+    # background writer (see set_output)
+    pending = None
+    writer = None
 
     def __init__(self, level='INFO'):
         self.f = sys.stdout
@@ -296,25 +434,64 @@ class Log:
 
     def flush(self):
         """ flush log file """
+        if self.pending is not None:
+            # wait for the writer thread to catch up
+            self.pending.join()
         if self.f != sys.stdout:
             self.f.flush()
 
     def close(self):
         """ close log file """
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join()
+            self.writer = None
+            self.pending = None
         if self.f != sys.stdout:
             self.f.close()
 
-    def _output(self, color, level, message):
+    def _drain(self):
+        """ background thread: drain the queue into the log file """
+        while True:
+            line = self.pending.get()
+            if line is None:
+                self.pending.task_done()
+                break
+            self.f.write(line)
+            if self.pending.empty():
+                # caught up, let readers (ltv-log -f) see it
+                self.f.flush()
+            self.pending.task_done()
+
+    def _output(self, color, level, message, args):
         """ internal method """
+        if args:
+            # lazy %-style arguments, only formatted when the level is enabled
+            message = message % args
         if self.f != sys.stdout:
-            self.f.write(level + " {}\n".format(message))
+            line = level + " {}\n".format(message)
+            if self.pending is not None:
+                self.pending.put(line)
+            else:
+                self.f.write(line)
         if (self.f == sys.stdout) or self.both:
             print(color + level + self.RESET + " {}".format(message))
 
-    def set_output(self, filename, mode='a', dualoutput=False):
-        """ assign output to log file """
-        self.f = open(filename, mode)
+    def set_output(self, filename, mode='a', dualoutput=False, buffersize=-1, threaded=False):
+        """
+        assign output to log file
+        buffersize: file buffer size in bytes (-1 = system default)
+        threaded:   hand writes to a background thread so a slow
+                    (e.g. network mounted) log never blocks the caller
+        """
+        self.f = open(filename, mode, buffering=buffersize)
         self.both = dualoutput
+        if threaded:
+            self.pending = queue.Queue()
+            self.writer = threading.Thread(target=self._drain, name='log', daemon=True)
+            self.writer.start()
+            # don't lose queued lines if we exit without closing
+            atexit.register(self.close)
 
     def set_level(self, level):
         """ set logging level """
@@ -324,27 +501,32 @@ class Log:
             print('BAD LOG LEVEL: {}'.format(level))
             sys.exit(1)
 
-    def debug(self, message):
+    def enabled(self, level):
+        """ would a message at this level be logged? """
+        return self.level <= self.levels[level]
+
+    def debug(self, message, *args):
         """ debug log message """
         if self.level > self.levels['DEBUG']:
             return
-        self._output(self.DEBUG, '[DEBUG]', message)
+        self._output(self.DEBUG, '[DEBUG]', message, args)
 
-    def info(self, message):
+    def info(self, message, *args):
         """ info log message """
         if self.level > self.levels['INFO']:
             return
-        self._output(self.INFO, '[INFO]', message)
+        self._output(self.INFO, '[INFO]', message, args)
 
-    def warning(self, message):
+    def warning(self, message, *args):
         """ warning log message """
         if self.level > self.levels['WARNING']:
             return
-        self._output(self.WARNING, '[WARNING]', message)
+        self._output(self.WARNING, '[WARNING]', message, args)
 
-    def error(self, message, retcode=1):
+    def error(self, message, *args, retcode=1):
         """ error log message """
         if self.level > self.levels['ERROR']:
             sys.exit(retcode)
-        self._output(self.ERROR, '[ERROR]', message)
+        self._output(self.ERROR, '[ERROR]', message, args)
+        self.flush()
         sys.exit(retcode)
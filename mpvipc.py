@@ -0,0 +1,130 @@
+""" LeeTV mpv remote control module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  mpvipc.py
+#
+#  Talk to a running mpv through its JSON IPC socket
+#  (mpv --input-ipc-server=<socket>)
+#
+#  Every command uses its own short connection, so a player
+#  that has been restarted is picked up without any fuss.
+#
+import json
+import time
+import socket
+
+
+class MpvError(Exception):
+    """ mpv refused a command or isn't listening """
+
+
+class MpvIpc:
+    """ LeeTV mpv remote control class """
+
+    # path of the IPC socket
+    path = ''
+    # seconds to wait for a reply
+    timeout = 5
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+
+    def command(self, *args):
+        """ run an mpv command, returns its 'data' (if any) """
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                sock.sendall(json.dumps({'command': list(args)}).encode('utf-8') + b'\n')
+                buf = b''
+                while True:
+                    data = sock.recv(4096)
+                    if not data:
+                        raise MpvError('mpv closed the connection')
+                    buf += data
+                    while b'\n' in buf:
+                        line, buf = buf.split(b'\n', 1)
+                        reply = json.loads(line.decode('utf-8', errors='replace'))
+                        # skip events, wait for the reply to our command
+                        if 'error' not in reply:
+                            continue
+                        if reply['error'] != 'success':
+                            raise MpvError('{}: {}'.format(args[0], reply['error']))
+                        return reply.get('data')
+        except (OSError, ValueError) as e:
+            raise MpvError(str(e))
+
+    def alive(self):
+        """ is mpv listening on the socket? """
+        try:
+            self.command('get_property', 'pid')
+        except MpvError:
+            return False
+        return True
+
+    def wait(self, seconds=10):
+        """ wait for a freshly started mpv to open its socket """
+        end = time.time() + seconds
+        while time.time() < end:
+            if self.alive():
+                return True
+            time.sleep(0.2)
+        return False
+
+    def get_property(self, name):
+        """ value of an mpv property """
+        return self.command('get_property', name)
+
+    def set_property(self, name, value):
+        """ change an mpv property """
+        return self.command('set_property', name, value)
+
+    def loadlist(self, playlist, mode='replace'):
+        """ load a playlist (replace what's playing, or append) """
+        return self.command('loadlist', playlist, mode)
+
+    def play_index(self, index):
+        """ jump to an item in the current playlist """
+        return self.command('playlist-play-index', index)
+
+    def seek(self, seconds):
+        """ jump to a position in the item playing """
+        return self.command('seek', seconds, 'absolute')
+
+    def join(self, index, seconds, wait=10):
+        """ play item index from seconds in, once it has started """
+        if self.get_property('playlist-pos') != index:
+            self.play_index(index)
+        end = time.time() + wait
+        while True:
+            try:
+                if self.get_property('playlist-pos') == index and self.get_property('time-pos') is not None:
+                    break
+            except MpvError:
+                # not loaded yet
+                pass
+            if time.time() > end:
+                raise MpvError('item {} did not start'.format(index))
+            time.sleep(0.1)
+        if seconds > 0:
+            self.seek(seconds)
@@ -35,10 +35,34 @@ import subprocess
 import shutil
 import random
 import math
+import time
 import urllib.parse
+from datetime import date, timedelta
 from configparser import ConfigParser
 
-from leeutils import which
+from leeutils import which, run, spawn, unique, read_medialist, lazy_import
+from catalog import Catalog
+from cache import DiskCache, make_key
+from filler import Filler, BUCKET
+from rotation import Rotation, air_time
+
+# only needed for merged breaks and the hls player
+futures = lazy_import('concurrent.futures')
+hls = lazy_import('hls')
+transcode = lazy_import('transcode')
+
+# longest a merged break may take ffmpeg (seconds)
+BREAK_TIMEOUT = 300
+
+# limits for the per-item player buffer (bytes), the minimum is
+# mpv's own default (demuxer-max-bytes), which items that need less keep
+READAHEAD_MIN = 150 * 1024 * 1024
+READAHEAD_MAX = 1024 * 1024 * 1024
+
+# mid-show breaks: no break this close to the start/end of a video,
+# and none shorter than this (ms)
+MIDSHOW_EDGE = 5 * 60 * 1000
+MIDSHOW_MIN_BREAK = 60 * 1000
 
 
 class Playlist:
@@ -48,6 +72,13 @@ class Playlist:
     master_name = []
     # list of running times for each video
     master_time = []
+    # series of each video (None for canned videos)
+    master_series = []
+    # (start_ms, end_ms) of each video that only plays a part of its file, or None
+    master_span = []
+    # {merged break: one of its videos}, the catalog entry of which
+    # stands in for the break's (playback gain, player buffer)
+    stand_in = {}
     # list of all commercials
     cn = []
     # running times for all commercials
@@ -76,6 +107,18 @@ class Playlist:
     weather_video_time = '25000'
     news_video_name = 'news.mp4'
     news_video_time = '25000'
+    # size budget for merged commercial breaks (MB)
+    break_cache_mb = '2048'
+    # size budget for ahead-of-air transcodes (MB)
+    transcode_cache_mb = '20480'
+    # size limit for exact-length fill videos (MB)
+    filler_cache_mb = '2048'
+    # 'pool' (use up a shuffled pool, then reload it) or 'cooldown' (see rotation.py)
+    commercial_rotation = 'pool'
+    # hours a commercial sits out after airing (commercialrotation = cooldown)
+    commercial_cooldown_hrs = '24'
+    # seconds of video the player should buffer ahead
+    readahead_s = 30
 
     bumper_video = ''
     fill_video = ''
@@ -84,21 +127,58 @@ class Playlist:
     news_video = ''
     directory = ''
     log = ''
+    catalog = None
+    # airing history (history.History), optional
+    history = None
+    # exact-length fill videos (filler.Filler), see use_exact_fill()
+    filler = None
+    # commercial rotation by cooldown (rotation.Rotation), see use_rotation()
+    rotation = None
+    # day the rotation is airing (YYYYMMDD)
+    rotation_day = ''
+    # what preflight() did: files checked, missing, replaced, time taken
+    preflight_stats = None
+    # media lists already read {filename: (mtime, names, times)}
+    # (shared by all instances, see get_filelist)
+    filelists = {}
     subdirs = ('config', 'sched', 'media', 'log')
     schedfiles = ('mon.ini', 'tue.ini', 'wed.ini', 'thu.ini',
                   'fri.ini', 'sat.ini', 'sun.ini')
 
-    def __init__(self, logger, exclude):
-        """ playlist object initializer """
+    def __init__(self, logger, exclude, check=True):
+        """
+        playlist object initializer
+        (check=False: only play what's there, e.g. leetv --fetch, so
+        no media lists, schedules or canned videos are needed)
+        """
         self.log = logger
 
+        # per-day state lives in the instance, so a long running
+        # process (leetv --daemon) can build one playlist per day
+        self.master_name = []
+        self.master_time = []
+        self.master_series = []
+        self.master_span = []
+        self.stand_in = {}
+        self.used = []
+        self.running_time_ms = 0
+        self.drift_ms = 0
+        self.commercial_reset = False
+        self.rotation = None
+        self.preflight_stats = {'checked': 0, 'missing': 0, 'replaced': 0, 'seconds': 0.0}
+
         # check the config directory tree for validity
         self.directory = os.path.join(os.getenv('HOME'), '.leetv')
+        if not check:
+            for subdir in ('config', 'log'):
+                os.makedirs(os.path.join(self.directory, subdir), exist_ok=True)
+            return
         self._check_prerequisites(self.directory, exclude)
 
         # get list of used commercials and remove them from the master commercial list
+        # (not needed when commercials rotate by cooldown)
         self.used_filename = os.path.join(self.directory, 'config', 'used.lst')
-        if os.path.isfile(self.used_filename):
+        if self.commercial_rotation == 'pool' and os.path.isfile(self.used_filename):
             with open(self.used_filename, 'r') as fp:
                 self.used = fp.readlines()
             for i, line in enumerate(self.used):
@@ -176,6 +256,13 @@ class Playlist:
                 self.weather_video_time = settings.get('LEETV_SETTINGS', 'weathervideotime', fallback=self.weather_video_time)
                 self.news_video_name = settings.get('LEETV_SETTINGS', 'newsvideo', fallback=self.news_video_name)
                 self.news_video_time = settings.get('LEETV_SETTINGS', 'newsvideotime', fallback=self.news_video_time)
+                self.break_cache_mb = settings.get('LEETV_SETTINGS', 'breakcache', fallback=self.break_cache_mb)
+                self.transcode_cache_mb = settings.get('LEETV_SETTINGS', 'transcodecache', fallback=self.transcode_cache_mb)
+                self.filler_cache_mb = settings.get('LEETV_SETTINGS', 'fillercache', fallback=self.filler_cache_mb)
+                self.commercial_rotation = settings.get('LEETV_SETTINGS', 'commercialrotation',
+                                                        fallback=self.commercial_rotation).lower()
+                self.commercial_cooldown_hrs = settings.get('LEETV_SETTINGS', 'commercialcooldown',
+                                                            fallback=self.commercial_cooldown_hrs)
 
             else:
                 settings.add_section('LEETV_SETTINGS')
@@ -288,42 +375,98 @@ class Playlist:
 
     def get_filelist(self, filename, shuffle=False):
         """ get media file list by filename, optionally shuffled """
-        f = list()
-        t = list()
-        if not os.path.isfile(filename):
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
             self.log.error('File {} does not exist!'.format(filename))
 
-        with open(filename, 'r') as fp:
-            lst = fp.readlines()
+        # only read a list again if it has changed since last time
+        cached = self.filelists.get(filename)
+        if not cached or cached[0] != mtime:
+            f, t = read_medialist(filename)
+            cached = (mtime, tuple(f), tuple(t))
+            self.filelists[filename] = cached
 
-        if not lst:
+        if not cached[1]:
             self.log.error('File {} has zero entries!'.format(filename))
 
         if shuffle:
-            random.shuffle(lst)
-        for x in lst:
-            a, b = x.split(' : ')
-            f.append(a.strip())
-            t.append(b.strip())
-        return (f, t)
-
-    def add_video(self, vname, vtime, logging=True, series=None):
+            pairs = list(zip(cached[1], cached[2]))
+            random.shuffle(pairs)
+            return [a for a, b in pairs], [b for a, b in pairs]
+        return list(cached[1]), list(cached[2])
+
+    def add_video(self, vname, vtime, logging=True, series=None, span=None):
         """ add video to master list """
-        s = "{} [{}]: {} : {:.3f} minutes".format(
-            self.running_time_ms_to_timestamp(self.running_time_ms),
-            series,
-            os.path.basename(urllib.parse.unquote(vname)),
-            self.ms_to_min(int(vtime)))
-
-        if logging:
-            self.log.info(s)
-        else:
-            self.log.debug(s)
+        # most videos (commercials, bumpers) are logged at DEBUG,
+        # so don't build the message unless someone will see it
+        level = 'INFO' if logging else 'DEBUG'
+        if self.log.enabled(level):
+            s = "{} [{}]: {} : {:.3f} minutes".format(
+                self.running_time_ms_to_timestamp(self.running_time_ms),
+                series,
+                os.path.basename(urllib.parse.unquote(vname)),
+                self.ms_to_min(int(vtime)))
+
+            if logging:
+                self.log.info(s)
+            else:
+                self.log.debug(s)
 
         self.master_name.append(vname)
         self.master_time.append(vtime)
+        self.master_series.append(series)
+        self.master_span.append(span)
         self.running_time_ms += int(vtime)
 
+    def choose_breaks(self, points, length_ms, every_ms):
+        """
+        pick break points (ms) about every_ms apart from the ones
+        ltv-analyze found, never too close to the start or end
+        """
+        chosen = []
+        last = 0
+        target = every_ms
+        while target < length_ms - MIDSHOW_EDGE:
+            near = [t for t in points
+                    if abs(t - target) <= every_ms / 3 and t - last >= every_ms / 2 and
+                    MIDSHOW_EDGE <= t <= length_ms - MIDSHOW_EDGE]
+            if near:
+                last = min(near, key=lambda t: abs(t - target))
+                chosen.append(last)
+                target = last + every_ms
+            else:
+                target += every_ms
+        return chosen
+
+    def add_segmented_video(self, vname, vtime, series, end_ms, every_ms):
+        """
+        add a long video in parts with commercial breaks in between,
+        using the time that would otherwise be filled after it (up to end_ms)
+        """
+        length = int(vtime)
+        points = self.get_catalog().breaks(vname)
+        cuts = self.choose_breaks(points, length, every_ms) if points else []
+        spare = end_ms - (self.running_time_ms + length)
+        # one share of the spare time per break, plus one for the end of the slot
+        room = max(int(spare // MIDSHOW_MIN_BREAK) - 1, 0)
+        if len(cuts) > room:
+            cuts = [cuts[i * len(cuts) // room] for i in range(room)] if room else []
+        if not cuts:
+            if points is None:
+                self.log.debug('No break points for %s (run ltv-analyze)', vname)
+            self.add_video(vname, vtime, series=series)
+            return
+
+        share = spare // (len(cuts) + 1)
+        self.log.debug('Mid-show breaks: %d x %.1fs', len(cuts), share / 1000)
+        start = 0
+        for cut in cuts + [length]:
+            self.add_video(vname, str(cut - start), series=series, span=(start, cut))
+            if cut < length:
+                self.do_commercial_fill(share)
+            start = cut
+
     def add_bumper_video(self):
         """ add bumper video to master list """
         if self.commercial_reset:
@@ -340,8 +483,27 @@ class Playlist:
         """ add news video to master list """
         self.add_video(self.news_video, self.news_video_time, logging=False)
 
-    def add_fill_video(self):
-        """ add fill video to master list """
+    def use_exact_fill(self):
+        """ cut fill video to the length of each gap from now on (see filler.py) """
+        if not which('ffmpeg'):
+            self.log.warning('ffmpeg not found in path, using the fixed length fill video')
+            return
+        self.filler = Filler(self.log, urllib.parse.unquote(self.fill_video),
+                             os.path.join(self.directory, 'cache', 'filler'),
+                             int(self.filler_cache_mb) * 1024 * 1024)
+
+    def add_filler(self, target_ms):
+        """ add an exact-length filler (to within a second), returns its length or 0 """
+        path, length = self.filler.get(target_ms)
+        if not path:
+            return 0
+        self.add_video(urllib.parse.quote(path), str(length), logging=False)
+        return length
+
+    def add_fill_video(self, target_ms=None):
+        """ add fill video to master list (cut to target_ms with --exact-fill) """
+        if self.filler and target_ms and self.add_filler(target_ms):
+            return
         self.add_video(self.fill_video, self.fill_video_time, logging=False)
 
     def do_commercial_fill(self, target_ms):
@@ -353,10 +515,28 @@ class Playlist:
         # fit, until we've gotten as close as possible to the target.
         # Any leftover time (drift) will self-correct at the next time slot.
         initial_target_ms = target_ms
+        if self.rotation:
+            target_ms = self.rotation_fill(target_ms)
+        else:
+            target_ms = self.pool_fill(target_ms)
+
+        # nothing short enough left, cut a filler to fit instead
+        if self.filler and target_ms >= BUCKET:
+            target_ms -= self.add_filler(target_ms)
+
+        self.log.debug("Filled: %.3fm Leftover: %.3fs",
+                       (initial_target_ms - target_ms) / 1000 / 60,
+                       target_ms / 1000)
+        # update maximum drift
+        if target_ms > self.drift_ms:
+            self.drift_ms = target_ms
+
+    def pool_fill(self, target_ms):
+        """ add commercials from the pool up to target_ms, returns the time left over """
         # set a realistic limit for # of retries
         limit = len(self.cn) * 10 + 1
         # try to fill remaining time to within 5 seconds
-        self.log.debug('Commercial Pool: {}'.format(len(self.cn)))
+        self.log.debug('Commercial Pool: %d', len(self.cn))
         while limit and (target_ms > 5000):
             if len(self.cn) < 10:
                 # we're almost out of commercials!
@@ -367,6 +547,7 @@ class Playlist:
                                                                   self.commercials_name + '.lst'),
                                                      shuffle=True)
                 self.used.clear()
+                self.drop_recent_commercials()
                 limit = len(self.cn) * 10 + 1
                 self.commercial_reset = True
 
@@ -381,27 +562,245 @@ class Playlist:
                 self.ct.pop(index)
             else:
                 limit -= 1
-
-        self.log.debug("Filled: {:.3f}m Leftover: {:.3f}s".format(
-            (initial_target_ms - target_ms) / 1000 / 60,
-            target_ms / 1000))
-        # update maximum drift
-        if target_ms > self.drift_ms:
-            self.drift_ms = target_ms
+        return target_ms
+
+    def use_rotation(self, today, start_ms):
+        """
+        rotate commercials by cooldown instead of using up a pool
+        (today is YYYYMMDD, the playlist starts start_ms after midnight)
+        """
+        names, times = self.get_filelist(os.path.join(self.directory, 'media', self.commercials_name + '.lst'))
+        now = air_time(today, start_ms)
+        last = {}
+        if self.history is not None:
+            # airings from now on are from an earlier run today, and are about to be replaced
+            aired = self.history.last_aired_before(names, today, start_ms)
+            for i, name in enumerate(names):
+                if name in aired:
+                    last[i] = air_time(*aired[name])
+        self.rotation = Rotation(names, times, last, int(float(self.commercial_cooldown_hrs) * 3600000), now)
+        self.rotation_day = today
+        self.log.info('Commercial rotation: {} commercials, {} cooling down'.format(
+            len(names), len(self.rotation.until)))
+
+    def rotation_fill(self, target_ms):
+        """ add commercials from the rotation up to target_ms, returns the time left over """
+        self.log.debug('Commercials cooling down: %d', len(self.rotation.until))
+        while target_ms > 5000:
+            now = air_time(self.rotation_day, self.running_time_ms)
+            index = self.rotation.draw(now, target_ms)
+            if index is None:
+                break
+            self.add_video(self.rotation.names[index], self.rotation.times[index], logging=False, series='Commercial')
+            self.rotation.aired(index, now)
+            target_ms -= int(self.rotation.times[index])
+        return target_ms
+
+    def drop_recent_commercials(self, days=1):
+        """ take commercials that aired in the last day or so out of a freshly reloaded pool """
+        if self.history is None:
+            return
+        since = int(date.strftime(date.today() - timedelta(days=days), '%Y%m%d'))
+        keep = [i for i, c in enumerate(self.cn)
+                if (self.history.last_aired(c) or (0,))[0] < since]
+        # not worth running short over
+        if len(keep) < 10:
+            return
+        self.log.debug('Dropped %d recently aired commercials', len(self.cn) - len(keep))
+        self.cn = [self.cn[i] for i in keep]
+        self.ct = [self.ct[i] for i in keep]
+
+    def get_catalog(self):
+        """ media catalog (loaded on first use) """
+        if self.catalog is None:
+            self.catalog = Catalog(os.path.join(self.directory, 'config', 'catalog.json'))
+        return self.catalog
+
+    def merge_breaks(self, mode):
+        """
+        collapse each commercial break into as few playlist items as possible
+          concat:  an .ffconcat descriptor that the player reads item by item
+          segment: a single file joined by stream copy (cached for reuse)
+        only neighbouring videos with identical streams and the same
+        playback gain are joined (the player applies one gain per item)
+        """
+        if mode not in ('concat', 'segment'):
+            self.log.error('Unknown break mode: {}'.format(mode))
+
+        if mode == 'segment' and not which('ffmpeg'):
+            self.log.warning('ffmpeg not found in path, not merging breaks')
+            return
+
+        catalog = self.get_catalog()
+        cache = DiskCache(os.path.join(self.directory, 'cache', 'breaks'),
+                          int(self.break_cache_mb) * 1024 * 1024)
+
+        # the fill video is a break all by itself, and news/weather are
+        # rewritten every hour - only an ffconcat (opened at play time)
+        # can refer to them
+        dynamic = (self.news_video, self.weather_video)
+
+        def mergeable(i):
+            name = self.master_name[i]
+            if name == self.fill_video or (mode == 'segment' and name in dynamic):
+                return False
+            return self.master_series[i] in (None, 'Commercial')
+
+        # look up (or probe) stream signatures in parallel
+        candidates = unique([self.master_name[i] for i in range(len(self.master_name)) if mergeable(i)])
+        with futures.ThreadPoolExecutor(max_workers=8) as pool:
+            sigs = dict(zip(candidates, pool.map(catalog.signature, candidates)))
+        catalog.save()
+        keys = {name: (sig, catalog.gain(name)) for name, sig in sigs.items() if sig}
+
+        names = []
+        times = []
+        series = []
+        spans = []
+        group = []
+        stats = {'breaks': 0, 'items': 0, 'hits': 0}
+
+        def flush():
+            merged = None
+            if len(group) > 1:
+                merged = self._merge_group(mode, cache, group, stats)
+            if merged:
+                # the same gain throughout, and the deepest buffer any of it needs
+                self.stand_in[urllib.parse.quote(merged)] = max(
+                    (self.master_name[i] for i in group),
+                    key=lambda n: catalog.readahead(n, self.readahead_s, probe=False) or 0)
+                names.append(urllib.parse.quote(merged))
+                times.append(str(sum(int(self.master_time[i]) for i in group)))
+                series.append('Break')
+                spans.append(None)
+            else:
+                for i in group:
+                    names.append(self.master_name[i])
+                    times.append(self.master_time[i])
+                    series.append(self.master_series[i])
+                    spans.append(self.master_span[i])
+            group.clear()
+
+        for i, name in enumerate(self.master_name):
+            if mergeable(i) and name in keys:
+                if group and keys[self.master_name[group[0]]] != keys[name]:
+                    flush()
+                group.append(i)
+            else:
+                flush()
+                group.append(i)
+                flush()
+        flush()
+
+        # trim once, with every break today's playlist refers to kept
+        # (trimming as they were made could delete the earlier ones)
+        merged = {urllib.parse.unquote(n) for n, s in zip(names, series) if s == 'Break'}
+        needed = sum(os.path.getsize(path) for path in merged if os.path.exists(path))
+        if needed > cache.budget:
+            self.log.warning('Merged breaks need {} MB, more than the break cache ({} MB), not merging'.format(
+                needed // (1024 * 1024), self.break_cache_mb))
+            for n in merged:
+                self.stand_in.pop(urllib.parse.quote(n), None)
+            cache.trim()
+            return
+        cache.trim(keep=merged)
+
+        self.log.info('Merged {} videos into {} breaks ({} from cache), playlist {} -> {} items'.format(
+            stats['items'], stats['breaks'], stats['hits'], len(self.master_name), len(names)))
+        self.master_name = names
+        self.master_time = times
+        self.master_series = series
+        self.master_span = spans
+
+    def _merge_group(self, mode, cache, group, stats):
+        """ merge one run of videos, return the path of the merged item or None """
+        files = [urllib.parse.unquote(self.master_name[i]) for i in group]
+
+        lines = ['ffconcat version 1.0']
+        for i, f in zip(group, files):
+            lines.append("file '{}'".format(f.replace("'", "'\\''")))
+            lines.append('duration {:.3f}'.format(int(self.master_time[i]) / 1000))
+        descriptor = '\n'.join(lines) + '\n'
+
+        if mode == 'concat':
+            key = make_key(descriptor)
+            path = cache.get(key, '.ffconcat')
+            if path:
+                stats['hits'] += 1
+            else:
+                tmp = cache.temp(key, '.ffconcat')
+                with open(tmp, 'w') as fp:
+                    fp.write(descriptor)
+                path = cache.commit(tmp, key, '.ffconcat', trim=False)
+        else:
+            catalog = self.get_catalog()
+            key = make_key(*[(f, catalog.get(n, 'size'), catalog.get(n, 'mtime'))
+                             for f, n in zip(files, (self.master_name[i] for i in group))])
+            path = cache.get(key, '.mkv')
+            if path:
+                stats['hits'] += 1
+            else:
+                listfile = cache.temp(key, '.ffconcat')
+                with open(listfile, 'w') as fp:
+                    fp.write(descriptor)
+                tmp = cache.temp(key, '.mkv')
+                try:
+                    returncode = run(['ffmpeg', '-v', 'error', '-y',
+                                      '-f', 'concat', '-safe', '0', '-i', listfile,
+                                      '-map', '0', '-c', 'copy', tmp],
+                                     timeout=BREAK_TIMEOUT).returncode
+                except (OSError, subprocess.TimeoutExpired):
+                    returncode = -1
+                os.remove(listfile)
+                if returncode:
+                    self.log.warning('Unable to merge break at {}'.format(files[0]))
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+                    return None
+                path = cache.commit(tmp, key, '.mkv', trim=False)
+
+        stats['breaks'] += 1
+        stats['items'] += len(group)
+        self.log.debug('Break: %d videos -> %s', len(group), path)
+        return path
 
     def write_used(self):
         """ write commercial updates to used.lst """
+        if self.rotation:
+            # the airing history is all the rotation needs
+            return
         self.log.info('Updating used.lst')
         with open(self.used_filename, 'w') as usedf:
             for i in self.used:
                 usedf.write(i + '\n')
 
-    def write_playlist(self, name, fmt='m3u8'):
-        """ create a playlist in one of several formats """
+    def write_playlist(self, name, fmt='m3u8', first=0):
+        """ create a playlist in one of several formats (of the items from first on) """
 
-        self.log.info("Creating {} playlist {}".format(fmt, name))
+        # the pieces of a playlist (first > 0) are only worth a debug line
+        report = self.log.debug if first else self.log.info
+        report("Creating {} playlist {}".format(fmt, name))
         playlist = open(name, 'w')
-        number_of_videos = len(self.master_name)
+        items = range(first, len(self.master_name))
+        number_of_videos = len(items)
+
+        # per-item playback gain measured by ltv-loudness (linear factor)
+        catalog = self.get_catalog()
+        gains = {}
+        for i in items:
+            db = catalog.gain(self.stand_in.get(self.master_name[i], self.master_name[i]))
+            gains[i] = '{:.3f}'.format(10 ** (db / 20)) if db else None
+        report("{} videos have a playback gain".format(number_of_videos - list(gains.values()).count(None)))
+
+        # per-item player buffer, sized from the bit rate recorded by the
+        # media list tools (never probed here, that's far too slow)
+        readahead = {}
+        for i in items:
+            need = catalog.readahead(self.stand_in.get(self.master_name[i], self.master_name[i]),
+                                     self.readahead_s, probe=False)
+            readahead[i] = min(need, READAHEAD_MAX) if need and need > READAHEAD_MIN else None
 
         if fmt.lower() == 'xspf':
             playlist.write('<?xml version="1.0" encoding="UTF-8"?>\n')
@@ -410,19 +809,26 @@ class Playlist:
             playlist.write('\t<title>Playlist</title>\n')
             playlist.write('\t<trackList>\n')
 
-            for i in range(number_of_videos):
+            for i in items:
                 playlist.write('\t\t<track>\n')
                 playlist.write('\t\t\t<location>file://{}</location>\n'.format(self.master_name[i]))
                 playlist.write('\t\t\t<duration>{}</duration>\n'.format(self.master_time[i]))
                 playlist.write('\t\t\t<extension application="http://www.videolan.org/vlc/playlist/0">\n')
                 playlist.write('\t\t\t\t<vlc:id>{}</vlc:id>\n'.format(i))
+                if gains[i]:
+                    playlist.write('\t\t\t\t<vlc:option>gain={}</vlc:option>\n'.format(gains[i]))
+                if self.master_span[i]:
+                    playlist.write('\t\t\t\t<vlc:option>start-time={:.3f}</vlc:option>\n'.format(
+                        self.master_span[i][0] / 1000))
+                    playlist.write('\t\t\t\t<vlc:option>stop-time={:.3f}</vlc:option>\n'.format(
+                        self.master_span[i][1] / 1000))
                 playlist.write('\t\t\t</extension>\n')
                 playlist.write('\t\t</track>\n')
 
             playlist.write('\t</trackList>\n')
             playlist.write('\t<extension application="http://www.videolan.org/vlc/playlist/0">\n')
 
-            for i in range(number_of_videos):
+            for i in items:
                 playlist.write('\t\t\t<vlc:item tid="{}"/>\n'.format(i))
 
             playlist.write('\t</extension>\n')
@@ -432,22 +838,31 @@ class Playlist:
         elif fmt.lower() == 'm3u8':
 
             playlist.write('#EXTM3U\n')
-            for i in range(number_of_videos):
+            for i in items:
                 name = urllib.parse.unquote(self.master_name[i])
                 playlist.write('#EXTINF:{}, {}\n'.format(
                     int(self.master_time[i]) // 1000,
                     os.path.splitext(os.path.basename(name))[0]))
+                if gains[i]:
+                    playlist.write('#EXTVLCOPT:gain={}\n'.format(gains[i]))
+                if readahead[i]:
+                    playlist.write('#LEETV:readahead={}\n'.format(readahead[i]))
+                if self.master_span[i]:
+                    # part of a file: an mpv edl (%length% guards odd characters)
+                    start, end = self.master_span[i]
+                    name = 'edl://%{}%{},{:.3f},{:.3f}'.format(len(name.encode('utf-8')), name,
+                                                                start / 1000, (end - start) / 1000)
                 playlist.write('{}\n'.format(name))
             playlist.close()
 
         elif fmt.lower() == 'pls':
 
             playlist.write('[playlist]\n')
-            for i in range(number_of_videos):
+            for i in items:
                 name = urllib.parse.unquote(self.master_name[i])
                 title = os.path.splitext(os.path.basename(name))[0]
                 length = int(self.master_time[i]) // 1000
-                seq = i + 1
+                seq = i - first + 1
                 playlist.write('File{}={}\n'.format(seq, name))
                 playlist.write('Title{}={}\n'.format(seq, title))
                 playlist.write('Length{}={}\n'.format(seq, length))
@@ -459,9 +874,160 @@ class Playlist:
         else:
             self.log.error('Unknown playlist type: {}'.format(fmt))
 
-        self.log.info("{} videos added to the playlist".format(number_of_videos))
-
-    def start_player(self, name, playlist, offset, streaming=False):
+        report("{} videos added to the playlist".format(number_of_videos))
+
+    def write_timeline(self, name, start_ms):
+        """
+        save start time, length, series and name of every item
+        (start_ms is where the playlist begins, ms since midnight)
+        """
+        with open(name, 'w') as fp:
+            t = start_ms
+            for vname, vtime, series in zip(self.master_name, self.master_time, self.master_series):
+                fp.write('{}\t{}\t{}\t{}\n'.format(t, vtime, series or '', vname))
+                t += int(vtime)
+
+    def preflight(self, checker, first=0):
+        """
+        put something else in place of every scheduled video (from first on)
+        whose file is gone, checker is a preflight.Preflight
+        (adds up what it did in preflight_stats)
+        """
+        start = time.time()
+        # where the playlist starts (ms since midnight)
+        start_ms = self.running_time_ms - sum(int(t) for t in self.master_time)
+        paths = {urllib.parse.unquote(n) for n, series in zip(self.master_name[first:], self.master_series[first:])
+                 if series is not None}
+        gone = checker.check(paths)
+
+        replaced = 0
+        if gone:
+            taken = set(self.master_name)
+            items = list(zip(self.master_name[first:], self.master_time[first:],
+                             self.master_series[first:], self.master_span[first:]))
+            del self.master_name[first:], self.master_time[first:], self.master_series[first:], self.master_span[first:]
+            for vname, vtime, series, span in items:
+                if series is None or urllib.parse.unquote(vname) not in gone:
+                    self.master_name.append(vname)
+                    self.master_time.append(vtime)
+                    self.master_series.append(series)
+                    self.master_span.append(span)
+                    continue
+                mark = len(self.master_name)
+                subs, gap_ms = self.substitute(checker, series, int(vtime), taken)
+                for sname, stime, sseries in subs:
+                    self.master_name.append(sname)
+                    self.master_time.append(stime)
+                    self.master_series.append(sseries)
+                    self.master_span.append(None)
+                    taken.add(sname)
+                if gap_ms > 5000:
+                    gap_ms = self.fill_gap(checker, start_ms, gap_ms)
+                added = self.master_name[mark:]
+                self.log.warning('Missing: {} ({})'.format(
+                    urllib.parse.unquote(vname),
+                    ', '.join(os.path.basename(urllib.parse.unquote(n)) for n in added) or 'nothing to put in its place'))
+                if added:
+                    replaced += 1
+                # the schedule runs early by whatever couldn't be filled
+                self.running_time_ms -= gap_ms
+                if gap_ms > self.drift_ms:
+                    self.drift_ms = gap_ms
+
+        stats = self.preflight_stats
+        stats['checked'] += len(paths)
+        stats['missing'] += len(gone)
+        stats['replaced'] += replaced
+        stats['seconds'] += time.time() - start
+
+    def fill_gap(self, checker, start_ms, gap_ms):
+        """
+        fill what substitute() couldn't with commercials, the way a
+        time slot is filled, returns the ms still left over
+        """
+        end_ms = self.running_time_ms
+        first = len(self.master_name)
+        # the fill functions add at running_time_ms, which is the gap for now
+        self.running_time_ms = start_ms + sum(int(t) for t in self.master_time)
+        gap_ms = self.rotation_fill(gap_ms) if self.rotation else self.pool_fill(gap_ms)
+        # the commercials could be gone too
+        for i in reversed(range(first, len(self.master_name))):
+            if not checker.exists(urllib.parse.unquote(self.master_name[i])):
+                gap_ms += int(self.master_time[i])
+                del self.master_name[i], self.master_time[i], self.master_series[i], self.master_span[i]
+        self.running_time_ms = end_ms
+        return gap_ms
+
+    def substitute(self, checker, series, length_ms, taken):
+        """
+        videos to air instead of a missing one of length_ms: the longest
+        episode of the same series that fits, then commercials for the
+        rest (or all commercials for a commercial), then a filler with
+        --exact-fill, returns ([(name, time, series)], ms left unfilled)
+        """
+        subs = []
+        gap_ms = length_ms
+        if series != 'Commercial':
+            filename = os.path.join(self.directory, 'media', series + '.lst')
+            if os.path.isfile(filename):
+                names, times = self.get_filelist(filename)
+                index = self.best_fit(checker, names, times, gap_ms, taken)
+                if index is not None:
+                    subs.append((names[index], times[index], series))
+                    gap_ms -= int(times[index])
+
+        names, times = self.get_filelist(os.path.join(self.directory, 'media', self.commercials_name + '.lst'))
+        while gap_ms > 5000:
+            index = self.best_fit(checker, names, times, gap_ms, taken)
+            if index is None:
+                break
+            subs.append((names[index], times[index], 'Commercial'))
+            taken = taken | {names[index]}
+            gap_ms -= int(times[index])
+
+        if self.filler and gap_ms >= BUCKET:
+            path, length = self.filler.get(gap_ms)
+            if path:
+                subs.append((urllib.parse.quote(path), str(length), None))
+                gap_ms -= length
+        return subs, gap_ms
+
+    def best_fit(self, checker, names, times, target_ms, taken):
+        """
+        index of the longest existing video no longer than target_ms
+        that isn't in the playlist yet, or a random one that is
+        (None if nothing fits)
+        """
+        fits = sorted((i for i in range(len(names)) if int(times[i]) <= target_ms),
+                      key=lambda i: (1, random.random()) if names[i] in taken else (0, -int(times[i])))
+        for i in fits:
+            if checker.exists(urllib.parse.unquote(names[i])):
+                return i
+        return None
+
+    def write_history(self, today, start_ms):
+        """ record every show and commercial in the airing history """
+        if self.history is None:
+            return
+        rows = []
+        t = start_ms
+        for vname, vtime, series in zip(self.master_name, self.master_time, self.master_series):
+            if series is not None:
+                rows.append((today, t, series, vname))
+            t += int(vtime)
+        self.history.append(rows)
+        self.log.debug('History: %d items recorded', len(rows))
+
+    def start_prefetch(self, timeline):
+        """ run ltv-prefetch in the background for the rest of the day """
+        script = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'ltv-prefetch')
+        if not os.path.isfile(timeline):
+            self.log.warning('No timeline {}, not prefetching'.format(timeline))
+            return None
+        self.log.info('Starting prefetch...')
+        return spawn([sys.executable, script, '-t', timeline], start_new_session=True)
+
+    def start_player(self, name, playlist, offset, streaming=False, port=8080, ahead=0, jobs=2, ipc='', start_index=0):
         """ launch a media player with playlist """
 
         if name.lower() != 'none':
@@ -476,38 +1042,46 @@ class Playlist:
                     self.log.error('mpv not found in path!')
             # *** these need to be checked ***
             elif host == 'Windows':
-                cmd = '"C:\\Program Files\\mpv\\mpv.exe"'
+                cmd = 'C:\\Program Files\\mpv\\mpv.exe'
             elif host.startswith('CYGWIN'):
-                cmd = r'/cygdrive/c/Program\ Files/mpv/mpv.exe'
+                cmd = '/cygdrive/c/Program Files/mpv/mpv.exe'
             else:
                 self.log.error('Unsupported system!')
 
+            # mpv ignores #EXTVLCOPT, so per-item gain is applied by a small script
+            gain = []
+            script = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'leetv-gain.lua')
+            if playlist.endswith('.m3u8') and os.path.isfile(script):
+                gain = ['--script=' + script, '--script-opts=leetv-gain-playlist=' + playlist]
+
+            # remote control socket (leetv --daemon), stay open after the
+            # last item so tomorrow's playlist can be loaded into it
+            control = []
+            if ipc:
+                control = ['--idle=yes', '--input-ipc-server=' + ipc]
+            # join a playlist that started earlier at the item on air now
+            if start_index:
+                control.append('--playlist-start={}'.format(start_index))
+
             if streaming:
                 # *** need to add streaming cmds ***
-                cmdline = ' '.join([cmd,
-                                    '--fullscreen',
-                                    '--ontop',
-                                    '--no-sub-auto',
-                                    '--no-sub-visibility',
-                                    '--playlist=' + playlist])
+                cmdline = [cmd,
+                           '--fullscreen',
+                           '--ontop',
+                           '--no-sub-auto',
+                           '--no-sub-visibility'] + gain + control + ['--playlist=' + playlist]
             else:
-                cmdline = ' '.join([cmd,
-                                    '--fullscreen',
-                                    '--ontop',
-                                    '--no-sub-auto',
-                                    '--no-sub-visibility',
-                                    '--playlist=' + playlist])
-
-            result = subprocess.Popen(cmdline,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.DEVNULL,
-                                      # stdout=subprocess.PIPE,
-                                      # stderr=subprocess.PIPE,
-                                      shell=True)
+                cmdline = [cmd,
+                           '--fullscreen',
+                           '--ontop',
+                           '--no-sub-auto',
+                           '--no-sub-visibility'] + gain + control + ['--playlist=' + playlist]
+
+            result = spawn(cmdline)
 
         elif name.lower() == 'vlc':
 
-            scmd = "--sout '#transcode{vcodec=mp4v,acodec=mpga,vb=800,ab=128,deinterlace}:rtp{mux=ts,dst=239.255.0.0,sdp=sap,name=LeeTV}'"
+            scmd = ['--sout', '#transcode{vcodec=mp4v,acodec=mpga,vb=800,ab=128,deinterlace}:rtp{mux=ts,dst=239.255.0.0,sdp=sap,name=LeeTV}']
             # "--sout '#transcode{vcodec=mp4v,acodec=mpga,vb=800,ab=128}:standard{access=http,mux=ogg,dst=192.168.0.28:8080}'"
             # "--sout '#transcode{vcodec=x264{profile=baseline,level=13,crf=24},acodec=mp4a,ab=128}:rtp{mux=ts,dst=239.255.0.0,sdp=sap,name=\"LeeTV\"}'"
             # "--sout '#duplicate{dst=display,dst=\"transcode{vcodec=mp4v,acodec=mpga,vb=800,ab=128,deinterlace}:rtp{mux=ts,dst=239.255.0.0,sdp=sap,name=LeeTV}'",
@@ -524,36 +1098,54 @@ class Playlist:
             elif host == 'Darwin':
                 cmd = '/Applications/VLC.app/Contents/MacOS/VLC'
             elif host == 'Windows':
-                cmd = '"C:\\Program Files\\VideoLAN\\VLC\\vlc.exe"'
+                cmd = 'C:\\Program Files\\VideoLAN\\VLC\\vlc.exe'
             elif host.startswith('CYGWIN'):
-                cmd = r'/cygdrive/c/Program\ Files/VideoLAN/VLC/vlc.exe'
+                cmd = '/cygdrive/c/Program Files/VideoLAN/VLC/vlc.exe'
             else:
                 self.log.error('Unsupported system!')
 
             if streaming:
-                cmdline = ' '.join([cmd,
-                                    # '--fullscreen',
-                                    # '--no-video-title-show',
-                                    '--play-and-exit',
-                                    '--verbose 0',
-                                    '--quiet-synchro',
-                                    playlist,
-                                    scmd])
+                cmdline = [cmd,
+                           # '--fullscreen',
+                           # '--no-video-title-show',
+                           '--play-and-exit',
+                           '--verbose', '0',
+                           '--quiet-synchro',
+                           playlist] + scmd
+            else:
+                cmdline = [cmd,
+                           '--fullscreen',
+                           '--no-video-title-show',
+                           '--play-and-exit',
+                           '--verbose', '0',
+                           '--quiet-synchro',
+                           playlist]
+
+            result = spawn(cmdline)
+        elif name.lower() == 'hls':
+            # we are the player: feed the timeline into a live HLS
+            # channel and serve it over HTTP until the end of the day
+            if not which('ffmpeg'):
+                self.log.error('ffmpeg not found in path!')
+            if self.master_name:
+                names, times = self.master_name, self.master_time
+                start_ms = offset * 1000
+            elif playlist.endswith('.m3u8'):
+                # existing playlist (--noplaylist)
+                names, times, start_ms = hls.read_playlist(playlist)
             else:
-                cmdline = ' '.join([cmd,
-                                    '--fullscreen',
-                                    '--no-video-title-show',
-                                    '--play-and-exit',
-                                    '--verbose 0',
-                                    '--quiet-synchro',
-                                    playlist])
-
-            result = subprocess.Popen(cmdline,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.DEVNULL,
-                                      # stdout=subprocess.PIPE,
-                                      # stderr=subprocess.PIPE,
-                                      shell=True)
+                self.log.error('HLS needs an m3u8 playlist')
+            pretranscoder = None
+            if ahead > 0:
+                # transcode the next few hours before they air
+                cache = DiskCache(os.path.join(self.directory, 'cache', 'transcode'),
+                                  int(self.transcode_cache_mb) * 1024 * 1024)
+                pretranscoder = transcode.Pretranscoder(self.log, cache, self.get_catalog(), ahead, jobs)
+            channel = hls.HlsChannel(self.log, os.path.join(self.directory, 'hls'), port,
+                                 self.get_catalog(), pretranscoder)
+            channel.run(names, times, start_ms)
+            result = None
+
         elif name.lower() == 'none':
             # allow user to select 'none' for player
             result = None
@@ -0,0 +1,161 @@
+""" LeeTV media prefetch module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  prefetch.py
+#
+#  Wake up slow storage before the player needs it
+#
+#  Follows the day's timeline (written by leetv next to the
+#  playlist) and, a few minutes before each item airs, stats
+#  it and reads its first few megabytes so a spun-down disk
+#  is awake and the start of the file is in the page cache.
+#
+#  Timeline format, one item per line:
+#
+#      start_ms <tab> length_ms <tab> series <tab> quoted_name
+#
+import os
+import time
+import urllib.parse
+from datetime import datetime
+
+# how long before air time to warm an item (seconds)
+LEAD = 300
+# how much of each item to read (MB)
+MEGABYTES = 32
+# read size
+CHUNK = 1024 * 1024
+
+
+def read_timeline(filename):
+    """ return [(start_ms, length_ms, series, name)] from a timeline file """
+    timeline = []
+    with open(filename, 'r') as fp:
+        for line in fp:
+            start, length, series, name = line.rstrip('\n').split('\t')
+            timeline.append((int(start), int(length), series or None, name))
+    return timeline
+
+
+def current_position(timeline, ms):
+    """
+    (index, ms into it) of the timeline item on air at ms since midnight,
+    or None once the timeline has ended
+    """
+    for i, (start_ms, length_ms, series, name) in enumerate(timeline):
+        if start_ms + length_ms > ms:
+            return i, max(ms - start_ms, 0)
+    return None
+
+
+def warm(path, nbytes):
+    """
+    stat a file and read (at most) its first nbytes
+    returns (stat seconds, read seconds, bytes read)
+    raises OSError if the file is missing or unreadable
+    """
+    start = time.time()
+    st = os.stat(path)
+    stat_s = time.time() - start
+    nbytes = min(nbytes, st.st_size)
+
+    start = time.time()
+    nread = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, nbytes, os.POSIX_FADV_WILLNEED)
+        while nread < nbytes:
+            data = os.read(fd, min(CHUNK, nbytes - nread))
+            if not data:
+                break
+            nread += len(data)
+    finally:
+        os.close(fd)
+    return stat_s, time.time() - start, nread
+
+
+def clock(ms):
+    """ ms since midnight as hh:mm:ss """
+    s = int(ms // 1000)
+    return '{:02d}:{:02d}:{:02d}'.format(s // 3600, s // 60 % 60, s % 60)
+
+
+class Prefetcher:
+    """ LeeTV media prefetch class """
+
+    log = None
+    # how long before air time to warm an item (ms)
+    lead_ms = LEAD * 1000
+    # how much of each item to read (bytes)
+    nbytes = MEGABYTES * CHUNK
+
+    def __init__(self, log, lead=LEAD, megabytes=MEGABYTES):
+        self.log = log
+        self.lead_ms = lead * 1000
+        self.nbytes = megabytes * CHUNK
+        self.midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def now_ms(self):
+        """ ms since (today's) midnight """
+        return (datetime.now() - self.midnight).total_seconds() * 1000
+
+    def check(self, timeline):
+        """ flag every item still to come that isn't there, returns their names """
+        now_ms = self.now_ms()
+        missing = []
+        seen = set()
+        for start_ms, length_ms, series, name in timeline:
+            if start_ms + length_ms < now_ms or name in seen:
+                continue
+            seen.add(name)
+            if not os.path.isfile(urllib.parse.unquote(name)):
+                missing.append(name)
+                self.log.warning('Missing: {} ({}) airs at {}'.format(
+                    urllib.parse.unquote(name), series or '-', clock(start_ms)))
+        return missing
+
+    def run(self, timeline):
+        """ warm each item lead_ms before it airs, until the end of the timeline """
+        timeline = sorted(timeline)
+        missing = self.check(timeline)
+        self.log.info('Prefetching {} items, {} missing'.format(len(timeline), len(missing)))
+
+        # by air time: an item that airs again later may have left the page cache since
+        warmed = set()
+        for start_ms, length_ms, series, name in timeline:
+            now_ms = self.now_ms()
+            if start_ms + length_ms < now_ms or start_ms in warmed:
+                continue
+            if start_ms - self.lead_ms > now_ms:
+                time.sleep((start_ms - self.lead_ms - now_ms) / 1000)
+            path = urllib.parse.unquote(name)
+            try:
+                stat_s, read_s, nread = warm(path, self.nbytes)
+            except OSError as e:
+                self.log.warning('Missing: {} airs at {} ({})'.format(path, clock(start_ms), e.strerror))
+                continue
+            warmed.add(start_ms)
+            mb = nread / CHUNK
+            self.log.info('Prefetch {} {}: stat {:.0f}ms, {:.1f}MB in {:.2f}s ({:.1f}MB/s)'.format(
+                clock(start_ms), os.path.basename(path), stat_s * 1000, mb, read_s,
+                mb / read_s if read_s > 0 else 0))
@@ -0,0 +1,113 @@
+""" LeeTV playlist pre-flight check module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  preflight.py
+#
+#  Are the videos in the playlist still there?
+#
+#  The media lists are snapshots, so a file that has been
+#  renamed or deleted since ltv-listmedia ran only shows up as
+#  a skip in the player (and everything after it airs early).
+#  Playlist.preflight() asks this module which scheduled files
+#  are gone and puts something else in their place.
+#
+#  Instead of a stat per file (slow over a NAS), each directory
+#  is listed once, all of them at the same time, and the
+#  listing is kept until the directory's mtime changes.  Paths
+#  found missing are remembered too, so substitutes that are
+#  known to be gone aren't looked at twice.
+#
+#  A directory that can't be listed (a NAS or mount that is
+#  down) says nothing about its files, so they are kept.  Only
+#  a directory that is gone from a parent that can be read
+#  counts as deleted.
+#
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# directories listed at the same time
+JOBS = 16
+
+
+class Preflight:
+    """ LeeTV media file checker class """
+
+    log = None
+    # {directory: (mtime, set of names)}, shared so a long running
+    # process (leetv --daemon) only lists changed directories
+    listings = {}
+    # paths known to be missing
+    missing = set()
+    lock = threading.Lock()
+
+    def __init__(self, log, jobs=JOBS):
+        self.log = log
+        self.jobs = jobs
+
+    def listing(self, directory):
+        """ names in a directory (empty if it's gone), or None if it can't be read """
+        try:
+            mtime = os.stat(directory).st_mtime
+        except FileNotFoundError:
+            # deleted, or is the storage it was on unreachable?
+            return frozenset() if os.path.isdir(os.path.dirname(directory)) else None
+        except OSError:
+            return None
+        cached = self.listings.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            return None
+        self.listings[directory] = (mtime, names)
+        # it changed, whatever was missing may be back
+        with self.lock:
+            self.missing.difference_update([p for p in self.missing if os.path.dirname(p) == directory])
+        return names
+
+    def check(self, paths):
+        """ the paths (absolute) that don't exist (those in unreadable directories are kept) """
+        directories = {os.path.dirname(p) for p in paths}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            found = dict(zip(directories, pool.map(self.listing, directories)))
+        unreadable = sorted(d for d, names in found.items() if names is None)
+        if unreadable:
+            self.log.warning('Unable to list {} directories (e.g. {}), keeping their videos'.format(
+                len(unreadable), unreadable[0]))
+        gone = {p for p in paths
+                if found[os.path.dirname(p)] is not None and os.path.basename(p) not in found[os.path.dirname(p)]}
+        with self.lock:
+            self.missing.update(gone)
+        return gone
+
+    def exists(self, path):
+        """ does one path (absolute) exist? """
+        if path in self.missing:
+            return False
+        names = self.listing(os.path.dirname(path))
+        if names is None or os.path.basename(path) in names:
+            return True
+        with self.lock:
+            self.missing.add(path)
+        return False
@@ -0,0 +1,143 @@
+""" LeeTV progressive playback module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  progressive.py
+#
+#  Start playing before the playlist is finished (leetv --progressive)
+#
+#  As soon as the first time slot is built it's written out
+#  and mpv is started on it with a control socket.  Every slot
+#  after that is written to a small playlist of its own and
+#  appended to what mpv is playing ('loadlist ... append').
+#  Each slot is checked for missing files (preflight.py)
+#  before it's handed over.
+#  When the build is done the full playlist replaces the
+#  partial one on disk and mpv is told where to find the
+#  playback gains of everything it has been given.
+#
+#  Time to first frame (from the start of leetv to mpv showing
+#  a picture) is logged.
+#
+import os
+import time
+import threading
+
+from mpvipc import MpvIpc, MpvError
+from preflight import Preflight
+
+# how long to wait for the first frame (seconds)
+FIRST_FRAME_WAIT = 30
+
+
+class Progressive:
+    """ LeeTV progressive playback class """
+
+    log = None
+    # playlist.Playlist being built
+    playlist = None
+    # where the playlist goes (mpv starts on the first slot of it)
+    playlist_file = ''
+    # items already handed to mpv
+    sent = 0
+
+    def __init__(self, log, playlist, playlist_file, start_time_s):
+        """ start_time_s: when leetv started (time.time()) """
+        self.log = log
+        self.playlist = playlist
+        self.checker = Preflight(log)
+        self.playlist_file = playlist_file
+        self.part_file = playlist_file + '.part'
+        self.start_time_s = start_time_s
+        self.mpv = MpvIpc(os.path.join(playlist.directory, 'mpv.sock'))
+        self.watcher = None
+        self.sent = 0
+
+    def slot_done(self):
+        """ hand everything built so far to the player """
+        p = self.playlist
+        if len(p.master_name) == self.sent:
+            return
+        p.preflight(self.checker, first=self.sent)
+        if not self.sent:
+            self.start()
+        else:
+            self.append(self.part_file)
+        self.sent = len(p.master_name)
+
+    def start(self):
+        """ start mpv on the first slot """
+        p = self.playlist
+        p.write_playlist(self.playlist_file, fmt='m3u8')
+        if os.path.exists(self.mpv.path):
+            os.remove(self.mpv.path)
+        # stay open until everything is appended (see finish)
+        p.start_player('mpv', self.playlist_file, 0, ipc=self.mpv.path)
+        self.log.info('Player started after {:.2f} seconds ({} items)'.format(
+            time.time() - self.start_time_s, len(p.master_name)))
+        self.watcher = threading.Thread(target=self.first_frame, name='first-frame', daemon=True)
+        self.watcher.start()
+
+    def append(self, filename):
+        """ append the items built since the last call """
+        self.playlist.write_playlist(filename, fmt='m3u8', first=self.sent)
+        if not self.mpv.wait():
+            self.log.warning('mpv is not listening on {}, not appending'.format(self.mpv.path))
+            return
+        try:
+            self.mpv.loadlist(filename, 'append')
+        except MpvError as e:
+            self.log.warning('Unable to append to the playlist: {}'.format(e))
+
+    def first_frame(self):
+        """ background thread: log how long it took for a picture to show up """
+        end = time.time() + FIRST_FRAME_WAIT
+        if not self.mpv.wait(FIRST_FRAME_WAIT):
+            return
+        while time.time() < end:
+            try:
+                if self.mpv.get_property('time-pos') is not None:
+                    self.log.info('Time to first frame: {:.2f} seconds'.format(time.time() - self.start_time_s))
+                    return
+            except MpvError:
+                pass
+            time.sleep(0.05)
+        self.log.warning('No picture after {} seconds'.format(FIRST_FRAME_WAIT))
+
+    def finish(self):
+        """ the build is done (and the full playlist written): hand over the rest """
+        if not self.sent:
+            return
+        if len(self.playlist.master_name) > self.sent:
+            self.append(self.part_file)
+            self.sent = len(self.playlist.master_name)
+        try:
+            os.remove(self.part_file)
+        except OSError:
+            pass
+        try:
+            # playback gains for everything (leetv-gain.lua)
+            self.mpv.command('script-message', 'leetv-gain-playlist', self.playlist_file)
+            # and quit at the end of the day like a normal run
+            self.mpv.set_property('idle', 'no')
+        except MpvError as e:
+            self.log.warning('Unable to update the player: {}'.format(e))
+        self.watcher.join(FIRST_FRAME_WAIT)
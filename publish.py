@@ -0,0 +1,317 @@
+""" LeeTV playlist distribution module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  publish.py
+#
+#  Build once, play on many TVs
+#
+#  'leetv --publish' copies the day's playlist and timeline,
+#  plus settings.ini and used.lst, into ~/.leetv/publish and
+#  serves them over HTTP:
+#
+#      /manifest.json         what's published (below)
+#      /files/<name>          one published file
+#
+#  Every reply carries an ETag (the sha256 of its contents) and
+#  honours If-None-Match, so asking again costs a 304.
+#
+#  'leetv --fetch http://host:port' (on the playback boxes)
+#  downloads only the files whose hash changed and then plays
+#  the playlist from the item that's on air now.
+#
+#  Media files are expected at the same paths on every box
+#  (the same NAS mounts).  The canned videos (bumper, fill,
+#  news, weather) are each box's own: paths under the
+#  builder's ~/.leetv are rewritten to the playback box's.
+#  Merged breaks and exact-length fillers only exist on the
+#  builder, so leetv won't make them with --publish.
+#  A playback box that has its own settings.ini keeps it, the
+#  published one is only used to start a new box off.
+#
+#  Manifest:
+#
+#      {"day": "YYYYMMDD", "version": n, "format": "m3u8",
+#       "playlist": name, "timeline": name, "home": builder's ~/.leetv,
+#       "files": {name: {"dir": "" or "config", "sha256": ..., "size": n}}}
+#
+#  "dir" is where the file goes under ~/.leetv.
+#
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# default port for the publish service
+PORT = 8082
+MANIFEST = 'manifest.json'
+# fetch: how long to wait for the builder to publish today
+WAIT = 300
+RETRY = 10
+# where fetched files may go under ~/.leetv
+FETCH_DIRS = ('', 'config')
+
+
+def sha256(filename):
+    """ sha256 of a file (hex), or None if it can't be read """
+    h = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                h.update(block)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def replace_file(data, filename):
+    """ write a file atomically """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, filename)
+
+
+def publish(directory, day, fmt, playlist, timeline):
+    """
+    publish the day's files into directory/publish, returns the manifest
+    (directory is ~/.leetv)
+    """
+    pub = os.path.join(directory, 'publish')
+    os.makedirs(pub, exist_ok=True)
+    try:
+        with open(os.path.join(pub, MANIFEST), 'r') as fp:
+            version = json.load(fp).get('version', 0) + 1
+    except (OSError, ValueError):
+        version = 1
+
+    files = {}
+    for path, where in ((playlist, ''), (timeline, ''),
+                        (os.path.join(directory, 'config', 'settings.ini'), 'config'),
+                        (os.path.join(directory, 'config', 'used.lst'), 'config')):
+        if not os.path.isfile(path):
+            continue
+        name = os.path.basename(path)
+        shutil.copyfile(path, os.path.join(pub, name + '.tmp'))
+        os.replace(os.path.join(pub, name + '.tmp'), os.path.join(pub, name))
+        files[name] = {'dir': where,
+                       'sha256': sha256(os.path.join(pub, name)),
+                       'size': os.path.getsize(os.path.join(pub, name))}
+
+    manifest = {'day': day, 'version': version, 'format': fmt,
+                'playlist': os.path.basename(playlist), 'timeline': os.path.basename(timeline),
+                'home': directory, 'files': files}
+    # manifest last, so a fetch never sees files that aren't there yet
+    replace_file(json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'), os.path.join(pub, MANIFEST))
+
+    # yesterday's playlist and timeline
+    for name in os.listdir(pub):
+        if name != MANIFEST and name not in files:
+            try:
+                os.remove(os.path.join(pub, name))
+            except OSError:
+                pass
+    return manifest
+
+
+class PublishHandler(BaseHTTPRequestHandler):
+    """ serve the manifest and the files it lists """
+
+    directory = ''
+    # {path: (etag, mtime)}, hashes are only worked out again when a file changes
+    etags = None
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+    def etag(self, filename):
+        """ quoted sha256 of a file """
+        mtime = os.stat(filename).st_mtime
+        known = self.etags.get(filename)
+        if known is None or known[1] != mtime:
+            known = ('"{}"'.format(sha256(filename)), mtime)
+            self.etags[filename] = known
+        return known[0]
+
+    def do_GET(self):  # pylint: disable=C0111
+        if self.path == '/' + MANIFEST:
+            name = MANIFEST
+        elif self.path.startswith('/files/'):
+            name = self.path[7:]
+            try:
+                with open(os.path.join(self.directory, MANIFEST), 'r') as fp:
+                    published = json.load(fp)['files']
+            except (OSError, ValueError, KeyError):
+                published = {}
+            # nothing but what's in the manifest
+            if name not in published:
+                self.send_error(404)
+                return
+        else:
+            self.send_error(404)
+            return
+
+        filename = os.path.join(self.directory, name)
+        try:
+            etag = self.etag(filename)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            with open(filename, 'rb') as fp:
+                body = fp.read()
+        except OSError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if name == MANIFEST else 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PublishServer:
+    """ LeeTV playlist distribution service class """
+
+    log = None
+
+    def __init__(self, log, directory, host='0.0.0.0', port=PORT):
+        self.log = log
+        pub = os.path.join(directory, 'publish')
+        os.makedirs(pub, exist_ok=True)
+        handler = type('Handler', (PublishHandler,), {'directory': pub, 'etags': {}})
+        self.server = ThreadingHTTPServer((host, port), handler)
+
+    def start(self):
+        """ serve in the background """
+        threading.Thread(target=self.server.serve_forever, name='publish', daemon=True).start()
+        host, port = self.server.server_address[:2]
+        self.log.info('Publishing at http://{}:{}/{}'.format(host, port, MANIFEST))
+
+    def stop(self):
+        """ stop serving """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def get(url, etag=None):
+    """ (status, body, etag) of a GET, with If-None-Match if we have an etag """
+    request = urllib.request.Request(url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        with urllib.request.urlopen(request, timeout=30) as reply:
+            return reply.status, reply.read(), reply.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, None, etag
+        raise
+
+
+def local_paths(data, home, directory):
+    """ playlist/timeline data with the builder's ~/.leetv (plain or url-quoted) made ours """
+    for old, new in ((home, directory),
+                     (urllib.request.quote(home), urllib.request.quote(directory))):
+        data = data.replace(old.rstrip('/').encode('utf-8') + b'/', new.rstrip('/').encode('utf-8') + b'/')
+    return data
+
+
+def fetch(log, url, directory, day):
+    """
+    bring ~/.leetv up to date with what a builder published for day
+    (waiting a few minutes if it hasn't got that far yet),
+    returns the manifest
+    """
+    url = url.rstrip('/')
+    state_file = os.path.join(directory, 'fetch.json')
+    try:
+        with open(state_file, 'r') as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        state = {}
+    if state.get('url') != url:
+        state = {'url': url}
+
+    end = time.time() + WAIT
+    while True:
+        try:
+            status, body, etag = get(url + '/' + MANIFEST, state.get('etag'))
+        except (OSError, ValueError) as e:
+            log.error('Unable to fetch {}: {}'.format(url, e))
+        if status == 304:
+            manifest = state['manifest']
+        else:
+            manifest = json.loads(body.decode('utf-8'))
+            state['etag'] = etag
+            state['manifest'] = manifest
+        if manifest.get('day') == day:
+            break
+        if time.time() > end:
+            log.error('{} has not published {} (it has {})'.format(url, day, manifest.get('day')))
+        log.info('Waiting for {} to publish {}...'.format(url, day))
+        time.sleep(RETRY)
+
+    for name in (manifest['playlist'], manifest['timeline']):
+        if manifest['files'].get(name, {}).get('dir') != '':
+            log.error('{} published a playlist that is not in ~/.leetv: {!r}'.format(url, name))
+
+    # {name: sha256 of what was fetched}, the playlist and timeline
+    # are rewritten after they're fetched so they can't be hashed again
+    have = state.setdefault('files', {})
+    home = manifest.get('home')
+    fetched = 0
+    for name, entry in manifest['files'].items():
+        # only plain file names, and only into ~/.leetv or its config directory
+        if name != os.path.basename(name) or name in ('', '.', '..') or entry['dir'] not in FETCH_DIRS:
+            log.error('{} published a file outside {}: {!r} in {!r}'.format(url, directory, name, entry['dir']))
+        target = os.path.join(directory, entry['dir'], name)
+        if (entry['dir'], name) == ('config', 'settings.ini') and os.path.exists(target):
+            if sha256(target) != entry['sha256']:
+                log.info('Keeping the local {} (not the published one)'.format(target))
+            continue
+        if os.path.exists(target) and (have.get(name) == entry['sha256'] or sha256(target) == entry['sha256']):
+            continue
+        try:
+            status, data, _ = get(url + '/files/' + urllib.request.quote(name))
+        except (OSError, ValueError) as e:
+            log.error('Unable to fetch {}: {}'.format(name, e))
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            log.error('{} changed while it was fetched, try again'.format(name))
+        if name in (manifest['playlist'], manifest['timeline']) and home and home != directory:
+            data = local_paths(data, home, directory)
+        replace_file(data, target)
+        have[name] = entry['sha256']
+        fetched += 1
+        log.info('Fetched {} ({} bytes)'.format(name, len(data)))
+
+    log.info('Version {} of {}: {} of {} files fetched'.format(
+        manifest['version'], day, fetched, len(manifest['files'])))
+    with open(state_file, 'w') as fp:
+        json.dump(state, fp)
+    return manifest
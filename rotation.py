@@ -0,0 +1,182 @@
+""" LeeTV commercial rotation module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  rotation.py
+#
+#  Commercial rotation by cooldown (commercialrotation = cooldown)
+#
+#  Instead of using up a shuffled pool and reloading it, every
+#  commercial stays in rotation and just can't air again until
+#  its cooldown has passed.  Commercials are drawn at random,
+#  weighted (never aired ones twice as likely), from a sum tree
+#  so a draw or an update costs O(log n).  Commercials in
+#  cooldown sit in a heap ordered by when they come back.
+#
+#  When the times were last aired are taken from the airing
+#  history, so there's no separate state to keep.
+#
+#  Times are ms since 0001-01-01 (see air_time), so they keep
+#  counting across midnight.
+#
+import heapq
+import random
+import statistics
+from datetime import date
+
+DAY_MS = 24 * 60 * 60 * 1000
+# weight of a commercial out of cooldown, and of one that never aired
+WEIGHT = 1.0
+NEW_WEIGHT = 2.0
+# random draws before looking through everything for a fit
+TRIES = 64
+
+
+def air_time(day, offset_ms):
+    """ ms since 0001-01-01 of day (YYYYMMDD or date) + offset_ms """
+    if not isinstance(day, date):
+        day = date(int(str(day)[:4]), int(str(day)[4:6]), int(str(day)[6:8]))
+    return day.toordinal() * DAY_MS + int(offset_ms)
+
+
+class SumTree:
+    """ weights with O(log n) update and weighted draw """
+
+    def __init__(self, n):
+        self.size = 1
+        while self.size < max(n, 1):
+            self.size *= 2
+        self.tree = [0.0] * (2 * self.size)
+
+    def total(self):
+        """ sum of all weights """
+        return self.tree[1]
+
+    def weight(self, i):
+        """ weight of item i """
+        return self.tree[self.size + i]
+
+    def update(self, i, w):
+        """ set the weight of item i """
+        j = self.size + i
+        self.tree[j] = w
+        j //= 2
+        while j:
+            self.tree[j] = self.tree[2 * j] + self.tree[2 * j + 1]
+            j //= 2
+
+    def find(self, x):
+        """ item where the running sum of weights passes x (0 <= x < total) """
+        j = 1
+        while j < self.size:
+            left = self.tree[2 * j]
+            if x < left:
+                j = 2 * j
+            else:
+                x -= left
+                j = 2 * j + 1
+        return j - self.size
+
+
+class Rotation:
+    """ LeeTV commercial rotation class """
+
+    # commercial names and running times (ms, as strings like the media lists)
+    names = None
+    times = None
+    # how long a commercial sits out after airing (ms)
+    cooldown = 0
+
+    def __init__(self, names, times, last_aired, cooldown, now):
+        """ last_aired: {index: air_time} of commercials that have aired before """
+        self.names = names
+        self.times = times
+        self.cooldown = cooldown
+        self.last = dict(last_aired)
+        self.tree = SumTree(len(names))
+        # (back in rotation at, index), entries are dropped if 'until' has moved on
+        self.heap = []
+        self.until = {}
+        self.distances = []
+        self.early = 0
+        for i in range(len(names)):
+            last = self.last.get(i)
+            if last is None:
+                self.tree.update(i, NEW_WEIGHT)
+            elif last + cooldown > now:
+                self._cool(i, last + cooldown)
+            else:
+                self.tree.update(i, WEIGHT)
+
+    def _cool(self, i, until):
+        self.tree.update(i, 0.0)
+        self.until[i] = until
+        heapq.heappush(self.heap, (until, i))
+
+    def advance(self, now):
+        """ put commercials whose cooldown is over back in rotation """
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            until, i = heapq.heappop(heap)
+            if self.until.get(i) == until:
+                del self.until[i]
+                self.tree.update(i, WEIGHT)
+
+    def draw(self, now, target_ms):
+        """ index of a commercial no longer than target_ms to air at now, or None """
+        self.advance(now)
+        tree = self.tree
+        for _ in range(TRIES):
+            total = tree.total()
+            if total <= 0:
+                break
+            i = tree.find(random.random() * total)
+            if int(self.times[i]) <= target_ms:
+                return i
+
+        # short on time: any commercial in rotation that fits
+        fits = [i for i in range(len(self.names))
+                if tree.weight(i) > 0 and int(self.times[i]) <= target_ms]
+        if fits:
+            return random.choice(fits)
+
+        # everything that fits is cooling down, take the one closest to coming back
+        for until, i in sorted(self.heap):
+            if self.until.get(i) == until and int(self.times[i]) <= target_ms:
+                self.early += 1
+                return i
+        return None
+
+    def aired(self, i, now):
+        """ commercial i airs at now """
+        last = self.last.get(i)
+        if last is not None:
+            self.distances.append(now - last)
+        self.last[i] = now
+        self._cool(i, now + self.cooldown)
+
+    def report(self):
+        """ one line of repeat-distance statistics for the log """
+        if not self.distances:
+            return 'no repeats'
+        hours = [d / 3600000 for d in self.distances]
+        return 'repeat distance min {:.1f}h median {:.1f}h ({} repeats, {} before their cooldown)'.format(
+            min(hours), statistics.median(hours), len(hours), self.early)
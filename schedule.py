@@ -30,6 +30,7 @@
 import os
 import random
 from datetime import date
+from urllib.parse import unquote
 from configparser import ConfigParser
 
 
@@ -48,9 +49,13 @@ class Schedule:
     log = None
     # used for schedule comparisons (last_played)
     today = ''
+    # airing history (history.History), for random series
+    history = None
 
-    def __init__(self, log):
+    def __init__(self, log, history=None):
         self.log = log
+        self.history = history
+        self.played_cache = {}
         self.directory = os.path.join(os.getenv('HOME'), '.leetv')
 
         # open global settings file
@@ -70,6 +75,53 @@ class Schedule:
         day = date(today.year, today.month, today.day).weekday()
         return days[day]
 
+    def played(self, series):
+        """
+        episodes of a random series already played since it was last reset:
+        quoted paths, or names (no extension) where only the name was kept
+        """
+        if series not in self.played_cache:
+            rndseries = ConfigParser()
+            rndseries.read(os.path.join(self.directory, 'config', series + '.ini'))
+            names = set(rndseries.sections())
+            if self.history is not None:
+                # the history has the path of everything played since it began
+                first = self.history.first_day()
+                if first is not None:
+                    names = {n for n in names
+                             if int(rndseries.get(n, 'lastdate', fallback='0')) < first}
+                since = self.settings.get(series, 'resetdate', fallback='00000000')
+                names.update(m if '/' in m else os.path.splitext(m)[0]
+                             for m in self.history.aired_since(series, since))
+            self.played_cache[series] = names
+        return self.played_cache[series]
+
+    def was_played(self, played, name):
+        """ is the episode (quoted path) in the played set """
+        return (name in played
+                or os.path.splitext(os.path.basename(name))[0] in played
+                or os.path.splitext(os.path.basename(unquote(name)))[0] in played)
+
+    def pick_random(self, slot, fn):
+        """ pick a random episode that hasn't been played yet (resetting the series if they all have) """
+        played = self.played(slot['series'])
+        unplayed = [i for i, f in enumerate(fn) if not self.was_played(played, f)]
+        if not unplayed:
+            self.log.warning("Unable to find unplayed episode for {}".format(slot['series']))
+            rndseries_file = os.path.join(self.directory, 'config', slot['series'] + '.ini')
+            dst = os.path.join(self.directory, 'config', slot['series'] + '.old')
+            try:
+                if os.path.exists(rndseries_file):
+                    os.rename(rndseries_file, dst)
+                    self.log.warning("Series reset: moved {} to {}".format(rndseries_file, dst))
+            except OSError:
+                self.log.warning("Unable to create {}".format(dst))
+            # history before today no longer counts
+            self.settings.set(slot['series'], 'resetdate', self.today)
+            played.clear()
+            unplayed = list(range(len(fn)))
+        return random.choice(unplayed)
+
     def get_next_index(self, slot, fn, supplemental=False):
         """ get settings for this slot and pick the next episode (index) """
 
@@ -93,34 +145,7 @@ class Schedule:
                         self.log.warning("Series {} rolled over".format(slot['series']))
                         index -= len(fn)
                 else:  # slot['seq'] is 'random'
-                    index = random.randrange(0, len(fn))
-                    # check to see if we've picked this index in the past
-                    rndseries = ConfigParser()
-                    rndseries_file = os.path.join(self.directory, 'config', slot['series'] + '.ini')
-                    rndseries.read(rndseries_file)
-                    name = os.path.splitext(
-                        os.path.basename(fn[index]))[0]
-                    if rndseries.has_section(name):
-                        # already played this one
-                        # keep selecting random episodes until
-                        # we find an unplayed one
-                        tries = len(fn) * 10 + 1
-                        while tries:
-                            index = random.randrange(0, len(fn))
-                            name = os.path.splitext(
-                                os.path.basename(fn[index]))[0]
-                            if not rndseries.has_section(name):
-                                # we found an unplayed episode
-                                break
-                            tries -= 1
-                        if not tries:
-                            self.log.warning("Unable to find unplayed episode for {}".format(slot['series']))
-                            try:
-                                dst = os.path.join(self.directory, 'config', slot['series'] + '.old')
-                                os.rename(rndseries_file, dst)
-                                self.log.warning("Series reset: moved {} to {}".format(rndseries_file, dst))
-                            except OSError:
-                                self.log.warning("Unable to create {}".format(dst))
+                    index = self.pick_random(slot, fn)
         else:
             # no saved section, start a new one
             self.settings.add_section(slot['series'])
@@ -135,31 +160,7 @@ class Schedule:
                     slot['series'], slot['seq']))
                 index = int(slot['seq']) - 2
             else:  # slot['seq'] is 'random'
-                index = random.randrange(0, len(fn))
-                # check to see if we've picked this index in the past
-                rndseries = ConfigParser()
-                rndseries_file = os.path.join(self.directory, 'config', slot['series'] + '.ini')
-                rndseries.read(rndseries_file)
-                name = os.path.splitext(
-                    os.path.basename(fn[index]))[0]
-                if rndseries.has_section(name):
-                    tries = len(fn) * 10 + 1
-                    while tries:
-                        index = random.randrange(0, len(fn))
-                        name = os.path.splitext(
-                            os.path.basename(fn[index]))[0]
-                        if not rndseries.has_section(name):
-                            # we found an unplayed episode
-                            break
-                        tries -= 1
-                    if not tries:
-                        self.log.info("Unable to find unplayed episode for {}".format(slot['series']))
-                        try:
-                            dst = os.path.join(self.directory, 'config', slot['series'] + '.old')
-                            os.rename(rndseries_file, dst)
-                            self.log.warning("Series reset: moved {} to {}".format(rndseries_file, dst))
-                        except OSError:
-                            self.log.warning("Unable to create {}".format(dst))
+                index = self.pick_random(slot, fn)
 
         return index
 
@@ -191,6 +192,7 @@ class Schedule:
                 rndseries.read(rndseries_file)
                 name = os.path.splitext(
                     os.path.basename(fn[index]))[0]
+                self.played(slot['series']).add(fn[index])
                 if not rndseries.has_section(name):
                     self.log.debug("Marking played episode: {}".format(name))
                     rndseries.add_section(name)
@@ -0,0 +1,143 @@
+""" LeeTV ahead-of-air transcode module """
+# -*- coding: utf-8 -*-
+# pylint: disable=C0103,R0912,R0914,R0915,R1702
+#######################################################################
+#
+# Copyright © 2018 Jim Lee <jlee54@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#######################################################################
+
+#  transcode.py
+#
+#  Transcode upcoming playlist items into the stream profile
+#  before they air, so a heavy file never has to be encoded in
+#  real time.
+#
+#  A dispatcher thread follows the playlist clock and hands
+#  every item airing within the next few hours that can't be
+#  stream copied to a small pool of ffmpeg workers.  Results
+#  go into a DiskCache keyed by source path + mtime + profile,
+#  so reruns of a popular series are only ever encoded once.
+#
+import os
+import time
+import threading
+import subprocess
+import urllib.parse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from leeutils import run
+from cache import make_key
+from hls import TRANSCODE
+
+# name of the stream profile (part of the cache key)
+PROFILE = 'h264-aac-v1'
+# how often the dispatcher looks ahead (seconds)
+INTERVAL = 30
+# give up on a transcode after this long (seconds)
+TIMEOUT = 4 * 60 * 60
+
+
+class Pretranscoder:
+    """ LeeTV ahead-of-air transcode class """
+
+    log = None
+    cache = None
+    catalog = None
+    # how far ahead to transcode (ms)
+    horizon_ms = 0
+
+    def __init__(self, log, cache, catalog, horizon_hours=3, jobs=2):
+        self.log = log
+        self.cache = cache
+        self.catalog = catalog
+        self.horizon_ms = int(horizon_hours * 60 * 60 * 1000)
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.submitted = set()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.timeline = []
+
+    def key(self, name):
+        """ cache key for an item, None if it doesn't exist """
+        path = urllib.parse.unquote(name)
+        try:
+            mtime = int(os.stat(path).st_mtime)
+        except OSError:
+            return None
+        return make_key(path, mtime, PROFILE)
+
+    def lookup(self, name):
+        """ path of the transcoded item if it's ready, else None """
+        key = self.key(name)
+        return self.cache.get(key, '.mp4') if key else None
+
+    def start(self, names, times, start_ms):
+        """ start following the timeline in the background """
+        self.timeline = []
+        t = start_ms
+        for name, length in zip(names, times):
+            self.timeline.append((t, name))
+            t += int(length)
+        self.thread = threading.Thread(target=self._dispatch, name='transcode', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ stop dispatching and abandon queued work """
+        self.stopping.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch(self):
+        """ queue everything airing within the horizon that needs transcoding """
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        while not self.stopping.is_set():
+            now_ms = (datetime.now() - midnight).total_seconds() * 1000
+            for start_ms, name in self.timeline:
+                if start_ms > now_ms + self.horizon_ms:
+                    break
+                if start_ms < now_ms or name.endswith('.ffconcat'):
+                    continue
+                key = self.key(name)
+                if not key or key in self.submitted:
+                    continue
+                self.submitted.add(key)
+                if self.catalog.can_stream_copy(name) or self.cache.get(key, '.mp4'):
+                    continue
+                self.pool.submit(self._transcode, name, key)
+            self.stopping.wait(INTERVAL)
+
+    def _transcode(self, name, key):
+        """ worker: transcode one item into the cache """
+        path = urllib.parse.unquote(name)
+        tmp = self.cache.temp(key, '.mp4')
+        start = time.time()
+        try:
+            returncode = run(['ffmpeg', '-v', 'error', '-nostdin', '-y',
+                              '-i', path, '-map', '0:v:0', '-map', '0:a:0?'] +
+                             TRANSCODE + ['-movflags', '+faststart', tmp],
+                             timeout=TIMEOUT).returncode
+        except (OSError, subprocess.TimeoutExpired):
+            returncode = -1
+        if returncode:
+            self.log.warning('Unable to transcode {}'.format(path))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.cache.commit(tmp, key, '.mp4')
+        self.log.debug('Transcoded %s in %.1fs', os.path.basename(path), time.time() - start)